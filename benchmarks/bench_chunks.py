@@ -0,0 +1,310 @@
+"""
+Microbenchmarks of all chunk rendering paths.
+
+Every path is measured with cold and warm cache for several sizes of chunks
+tables, using SQLite database in memory and local memory cache. Results are
+written as JSON to compare them between commits:
+
+    python benchmarks/bench_chunks.py --sizes 10,1000 --output before.json
+"""
+import cPickle as pickle
+import json
+import optparse
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from django.conf import settings
+
+settings.configure(
+    DEBUG=True,
+    DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3',
+                           'NAME': ':memory:'}},
+    CACHES={'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'OPTIONS': {'MAX_ENTRIES': 10 ** 6}}},
+    INSTALLED_APPS=['django.contrib.contenttypes', 'chunks'],
+    CHUNKS_CACHE_TIME=3600,
+)
+
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection, models, reset_queries
+from django.http import HttpRequest, HttpResponse
+from django.template import Template, Context
+
+from chunks import context_processors
+from chunks.caching import chunks_cache, decode_value
+from chunks.middleware import ChunksMiddleware
+from chunks.models import Chunk, InlineChunk, ChunksModel, codechunk, \
+                          flush_pending_chunks
+from chunks.templatetags.chunks import do_filter_chunk
+
+
+class BenchPage(models.Model, ChunksModel):
+    title = models.CharField(max_length=100)
+
+    class Meta:
+        app_label = 'chunks'
+
+    class ChunksMeta:
+        chunks_cache_timeout = 3600
+
+
+# keys rendered by each operation
+KEYS_PER_OPERATION = 10
+INLINE_CHUNKS_PER_PAGE = 10
+# SQLite limits number of rows in one insert
+BATCH_SIZE = 100
+
+CACHE_METHODS = ('get', 'get_many', 'set', 'set_many', 'add', 'incr',
+                 'delete', 'delete_many')
+
+
+class CacheCounter(object):
+    """Counts calls of Django cache methods, e.g. `get` calls made by
+    `get_many` of the backend itself aren't counted, and size of written
+    values in compact format and in format they had before it"""
+    def __init__(self, backend):
+        self.reset()
+        self.depth = 0
+        for name in CACHE_METHODS:
+            setattr(backend, name, self.wrap(name, getattr(backend, name)))
+
+    def reset(self):
+        self.calls = 0
+        self.bytes = 0
+        self.raw_bytes = 0
+
+    def count_bytes(self, value):
+        self.bytes += len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+        self.raw_bytes += len(pickle.dumps(decode_value(value), \
+                                           pickle.HIGHEST_PROTOCOL))
+
+    def wrap(self, name, method):
+        def counted(*args, **kwargs):
+            if not self.depth:
+                self.calls += 1
+                if name == 'set':
+                    self.count_bytes(args[1])
+                elif name == 'set_many':
+                    for value in args[0].values():
+                        self.count_bytes(value)
+            self.depth += 1
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self.depth -= 1
+        return counted
+
+
+def populate(size, content_size=0):
+    """Fill tables with `size` chunks and `size` inline chunks, content of
+    chunks is padded to `content_size` characters"""
+    InlineChunk.objects.all().delete()
+    Chunk.objects.all().delete()
+    BenchPage.objects.all().delete()
+
+    Chunk.objects.bulk_create([Chunk(key='chunk_%d' % i,
+                                     content=padded('<p>Chunk %d content</p>'
+                                                    % i, content_size),
+                                     description='')
+                               for i in range(size)], batch_size=BATCH_SIZE)
+    pages = max(size // INLINE_CHUNKS_PER_PAGE, 1)
+    BenchPage.objects.bulk_create([BenchPage(title='page %d' % i)
+                                   for i in range(pages)],
+                                  batch_size=BATCH_SIZE)
+    page_ids = list(BenchPage.objects.values_list('id', flat=True))
+    model_type = InlineChunk._meta.get_field('content_type').rel.to\
+                    .objects.get_for_model(BenchPage)
+    InlineChunk.objects.bulk_create([
+        InlineChunk(key='inline_%d' % (i % INLINE_CHUNKS_PER_PAGE),
+                    desc='', content=padded('<p>Inline %d content</p>' % i,
+                                            content_size),
+                    content_type=model_type,
+                    object_id=page_ids[i // INLINE_CHUNKS_PER_PAGE])
+        for i in range(min(size, pages * INLINE_CHUNKS_PER_PAGE))],
+        batch_size=BATCH_SIZE)
+    return list(BenchPage.objects.all()[:KEYS_PER_OPERATION])
+
+
+def padded(content, size):
+    words = ' '.join('word%d' % (i % 50) for i in range(size // 6))
+    return (content + words)[:max(size, len(content))]
+
+
+def request():
+    r = HttpRequest()
+    r.LANGUAGE_CODE = 'en'
+    return r
+
+
+def chunk_keys(size):
+    step = max(size // KEYS_PER_OPERATION, 1)
+    return ['chunk_%d' % i for i in range(0, size, step)][:KEYS_PER_OPERATION]
+
+
+def scenarios(size, pages):
+    keys = chunk_keys(size)
+    chunk_template = Template('{% load chunks %}' + ''.join(
+                            '{%% chunk "%s" %%}' % key for key in keys))
+    object_chunk_template = Template('{% load chunks %}'
+                            '{% for p in pages %}'
+                            '{% object_chunk p "inline_0" 0 3600 %}'
+                            '{% endfor %}')
+    object_chunks_list_template = Template('{% load chunks %}'
+                            '{% for p in pages %}'
+                            '{% object_chunks_list p "c" %}{{ c.inline_0 }}'
+                            '{% endfor %}')
+    processor_template = Template(''.join('{{ CHUNKS.%s }}' % key
+                                          for key in keys))
+    html = '<html><body>%s</body></html>' % ('x' * 10000)
+
+    def render_chunk_tag():
+        return chunk_template.render(Context({'request': request()}))
+
+    def render_filter():
+        return u''.join(do_filter_chunk(key, 0) for key in keys)
+
+    def render_codechunk():
+        return u''.join(codechunk(key) for key in keys)
+
+    def render_object_chunk():
+        return object_chunk_template.render(Context({'request': request(),
+                                                     'pages': pages}))
+
+    def render_object_chunks_list():
+        return object_chunks_list_template.render(Context({
+                                                    'request': request(),
+                                                    'pages': pages}))
+
+    def render_context_processor():
+        context = Context(context_processors.chunks(request()))
+        return processor_template.render(context)
+
+    def render_middleware():
+        settings.CHUNKS_WRAP = True
+        try:
+            middleware = ChunksMiddleware()
+            r = request()
+            middleware.process_request(r)
+            for key in keys:
+                codechunk(key)
+            return middleware.process_response(r, HttpResponse(html)).content
+        finally:
+            settings.CHUNKS_WRAP = False
+
+    return [('chunk_tag', render_chunk_tag),
+            ('chunk_filter', render_filter),
+            ('codechunk', render_codechunk),
+            ('object_chunk', render_object_chunk),
+            ('object_chunks_list', render_object_chunks_list),
+            ('context_processor', render_context_processor),
+            ('middleware', render_middleware)]
+
+
+def reset_caches():
+    cache.clear()
+    context_processors._snapshot = (None, {})
+
+
+def measure(operation, warm, iterations, counter):
+    timings = []
+    queries = 0
+    cache_calls = 0
+    cache_bytes = 0
+    raw_bytes = 0
+    if warm:
+        reset_caches()
+        operation()
+    for i in range(iterations):
+        if not warm:
+            reset_caches()
+        reset_queries()
+        counter.reset()
+        started = time.time()
+        operation()
+        timings.append(time.time() - started)
+        queries += len(connection.queries)
+        cache_calls += counter.calls
+        cache_bytes += counter.bytes
+        raw_bytes += counter.raw_bytes
+    timings.sort()
+    return {'iterations': iterations,
+            'mean_ms': 1000 * sum(timings) / len(timings),
+            'median_ms': 1000 * timings[len(timings) // 2],
+            'min_ms': 1000 * timings[0],
+            'queries': float(queries) / iterations,
+            'cache_calls': float(cache_calls) / iterations,
+            'cache_bytes_written': float(cache_bytes) / iterations,
+            'cache_bytes_saved': float(raw_bytes - cache_bytes) / iterations,
+           }
+
+
+def revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], \
+                                       cwd=ROOT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--sizes', default='10,1000,100000',
+                      help='comma separated numbers of chunks')
+    parser.add_option('--iterations', type='int', default=20)
+    parser.add_option('--scenarios', default='',
+                      help='comma separated names of scenarios to run')
+    parser.add_option('--output', default='-',
+                      help='file to write JSON results to')
+    parser.add_option('--content-size', type='int', default=0,
+                      help='length of content of chunks')
+    parser.add_option('--compress-threshold', type='int', default=1024,
+                      help='values longer than this are compressed, '
+                           '0 disables compression')
+    options, args = parser.parse_args()
+    chunks_cache.encode = True
+    chunks_cache.compress_threshold = options.compress_threshold
+
+    call_command('syncdb', interactive=False, verbosity=0)
+    counter = CacheCounter(cache)
+    selected = [name for name in options.scenarios.split(',') if name]
+
+    results = []
+    for size in [int(size) for size in options.sizes.split(',')]:
+        pages = populate(size, options.content_size)
+        for name, operation in scenarios(size, pages):
+            if selected and name not in selected:
+                continue
+            for warm in (False, True):
+                result = measure(operation, warm, options.iterations, counter)
+                result.update({'scenario': name,
+                               'chunks': size,
+                               'cache': warm and 'warm' or 'cold'})
+                results.append(result)
+                sys.stderr.write('%(scenario)s %(chunks)d %(cache)s: '
+                                 '%(mean_ms).3f ms, %(queries).1f queries, '
+                                 '%(cache_calls).1f cache calls, '
+                                 '%(cache_bytes_saved).0f bytes saved\n'
+                                 % result)
+        flush_pending_chunks()
+
+    report = {'revision': revision(),
+              'python': sys.version.split()[0],
+              'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'results': results}
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if options.output == '-':
+        print output
+    else:
+        with open(options.output, 'w') as f:
+            f.write(output)
+
+
+if __name__ == '__main__':
+    main()
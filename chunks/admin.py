@@ -1,15 +1,44 @@
 from django.contrib import admin
+from django.contrib.admin.views.main import ChangeList
 from models import Chunk, InlineChunk
+from search import search_condition
 
 
-class ChunkAdmin(admin.ModelAdmin):
+class IndexedSearchChangeList(ChangeList):
+    """Searches chunks with full-text index if database supports it,
+    see `chunks.search`, instead of `icontains` lookups of search_fields"""
+    def get_query_set(self, request):
+        condition = search_condition(self.model, self.query)
+        if condition is None:
+            return super(IndexedSearchChangeList, self).get_query_set(request)
+
+        search_fields, self.search_fields = self.search_fields, ()
+        try:
+            qs = super(IndexedSearchChangeList, self).get_query_set(request)
+        finally:
+            self.search_fields = search_fields
+        where, params = condition
+        return qs.extra(where=[where], params=params)
+
+
+class IndexedSearchAdmin(admin.ModelAdmin):
+    def get_changelist(self, request, **kwargs):
+        return IndexedSearchChangeList
+
+
+class ChunkAdmin(IndexedSearchAdmin):
     list_display = ('description', 'key',)
     search_fields = ('description', 'key', 'content')
 
 
-class InlineChunkAdmin(admin.ModelAdmin):
+class InlineChunkAdmin(IndexedSearchAdmin):
     list_display = ('content_object', 'key')
-    search_fields = ('description', 'key', 'content')
+    search_fields = ('desc', 'key', 'content')
+
+    def queryset(self, request):
+        # objects of page are loaded with one query for each model
+        return super(InlineChunkAdmin, self).queryset(request)\
+                    .prefetch_related('content_object')
 
 
 admin.site.register(Chunk, ChunkAdmin)
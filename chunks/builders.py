@@ -1,11 +1,85 @@
+import hashlib
+import imp
+import logging
+import re
+import sys
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models.loading import get_model
+from django.db.models.signals import post_save, pre_delete
+from django.utils.importlib import import_module
+from django.utils.module_loading import module_has_submodule
 from django.utils.translation import ugettext_lazy as _
 
+from chunks.caching import chunks_cache, versioned_key, bump_namespace, \
+                           BUILDERS_NAMESPACE, COUNTER_TIMEOUT
+from chunks.tracking import current_stats
+
+logger = logging.getLogger(__name__)
+
+# labels of `cache_invalidate_on` models stored by processes which loaded
+# builders, so the others invalidate builders cache without loading them
+INVALIDATING_MODELS_KEY = 'chunks_builders_invalidating_models'
+# they are stored again after this number of seconds in case of eviction
+INVALIDATING_MODELS_REFRESH = 60
+
+
+def content_hash(content):
+    """Return digest of chunk content stable across processes"""
+    if isinstance(content, unicode):
+        content = content.encode('utf-8')
+    return hashlib.md5(content).hexdigest()
+
+
+def model_label(model):
+    """Return `app_label.modelname` for model class or label"""
+    if isinstance(model, basestring):
+        return model.lower()
+    return u'%s.%s' % (model._meta.app_label, model._meta.object_name.lower())
+
+
+def resolve_path(roots, path):
+    """Resolve dotted path like `request.user.pk` against `roots`
+    dictionary, return None if any part is missing"""
+    parts = path.split('.')
+    value = roots.get(parts[0])
+    for part in parts[1:]:
+        if value is None:
+            return None
+        try:
+            value = value[part]
+        except (TypeError, KeyError, AttributeError, IndexError, ValueError):
+            value = getattr(value, part, None)
+        if callable(value):
+            value = value()
+    return value
+
 
 class ChunkBuilder(object):
     chunk_names = None
+    # if True builder is used for chunks which contain its `id`
+    content_marker = False
     ident = u'base'
     title = _(u'Basic chunks builder')
 
+    # cache policy of rendered content. Output is cached for
+    # `cache_timeout` seconds, separately for each value of dotted paths
+    # in `cache_vary_on` (starting with request, context, chunk or
+    # parent), and it's dropped when any of `cache_invalidate_on` models
+    # (model classes or `app_label.modelname`) is saved or deleted
+    cache_timeout = None
+    cache_vary_on = ()
+    cache_invalidate_on = ()
+
+    # if True, builder may render chunks in pool threads concurrently with
+    # other chunks of the same object, see CHUNKS_BUILDER_THREADS. If it
+    # doesn't finish in `render_timeout` seconds raw content is used
+    thread_safe = False
+    render_timeout = None
+
     @property
     def id(self):
         return u'chunk=%s' % self.ident
@@ -16,6 +90,8 @@ class ChunkBuilder(object):
         if self.chunk_names set to None then builder will be default
         for all InlineChunks.
         """
+        if self.content_marker:
+            return chunk is not None and self.id in chunk.content
         if self.chunk_names == None or name in self.chunk_names:
             return True
         return False
@@ -24,3 +100,300 @@ class ChunkBuilder(object):
         """This method should be overriden by custom builder to generate or
         process content"""
         return chunk.content
+
+    @property
+    def cache_namespaces(self):
+        return [u'builder.%s' % self.ident] + \
+               [u'model.%s' % model_label(model) \
+                    for model in self.cache_invalidate_on]
+
+    def cache_key(self, request, chunk, parent=None, context={}):
+        roots = {'request': request, 'context': context, \
+                 'chunk': chunk, 'parent': parent}
+        vary = [resolve_path(roots, path) for path in self.cache_vary_on]
+        parent_id = None
+        if parent is not None:
+            parent_id = (model_label(parent.__class__), parent.pk)
+        return versioned_key('chunk_builder_', self.cache_namespaces, \
+                             model_label(chunk.__class__), chunk.pk, \
+                             content_hash(chunk.content), parent_id, vary)
+
+    def timed_render(self, request, chunk, parent=None, context={}):
+        """Render chunk and record time spent by builder if instrumentation
+        is enabled"""
+        stats = current_stats()
+        if stats is None:
+            return self.render(request, chunk, parent=parent, context=context)
+
+        started = time.time()
+        try:
+            return self.render(request, chunk, parent=parent, context=context)
+        finally:
+            stats.builder_time(self.ident, time.time() - started)
+
+    def cached_render(self, request, chunk, parent=None, context={}):
+        """Render chunk using cache policy of the builder"""
+        if not self.cache_timeout:
+            return self.timed_render(request, chunk, parent=parent, \
+                                     context=context)
+
+        cache_key = self.cache_key(request, chunk, parent, context)
+        content = chunks_cache.get(cache_key)
+        if content is None:
+            content = self.timed_render(request, chunk, parent=parent, \
+                                        context=context)
+            chunks_cache.set(cache_key, content, self.cache_timeout)
+        return content
+
+    def clear_cache(self):
+        """Drop all cached output of the builder"""
+        bump_namespace(self.cache_namespaces[0])
+        bump_namespace(BUILDERS_NAMESPACE)
+
+
+class BuilderIndex(object):
+    """
+    Finds builder for chunk without calling `appropriate_key` of each
+    builder. Builders with `chunk_names` are found by name, builders with
+    `content_marker` are found by one regular expression, only builders
+    which override `appropriate_key` are asked as before. The first
+    appropriate builder in list wins, as if all of them were asked in turn.
+    Chunks remember their builders, see `Chunk.builder`.
+    """
+    def __init__(self, builders):
+        self.builders = builders
+        self.by_name = {}
+        self.markers = {}
+        self.generic = []
+        self.catch_all = len(builders)
+        self.by_ident = {}
+
+        base_appropriate_key = ChunkBuilder.appropriate_key.im_func
+        positions = {}
+        for position, builder in enumerate(builders):
+            positions.setdefault(builder.ident, []).append(position)
+            if getattr(builder.appropriate_key, 'im_func', None) \
+                    is not base_appropriate_key:
+                self.generic.append(position)
+            elif builder.content_marker:
+                self.markers.setdefault(builder.ident, position)
+            elif builder.chunk_names is None:
+                # appropriate for any chunk, nothing after it is used
+                self.catch_all = position
+                break
+            else:
+                for name in builder.chunk_names:
+                    self.by_name.setdefault(name, position)
+        # builders sharing ident can't be told apart by it
+        for ident, found in positions.items():
+            if len(found) == 1:
+                self.by_ident[ident] = builders[found[0]]
+
+        self.markers_re = None
+        if self.markers:
+            idents = sorted(self.markers, key=len, reverse=True)
+            self.markers_re = re.compile(u'chunk=(%s)' % \
+                                u'|'.join(re.escape(i) for i in idents))
+
+    def resolve(self, name, chunk=None, obj=None):
+        """Return builder for chunk or None"""
+        position = self._resolve(name, chunk, obj)
+        if position < len(self.builders):
+            return self.builders[position]
+        return None
+
+    def builder_by_ident(self, ident):
+        """Return builder with unique `ident` or None"""
+        return self.by_ident.get(ident)
+
+    def _resolve(self, name, chunk, obj):
+        best = self.catch_all
+        position = self.by_name.get(name)
+        if position is not None and position < best:
+            best = position
+
+        if self.markers_re is not None and chunk is not None:
+            for match in self.markers_re.finditer(chunk.content):
+                found = match.group(1)
+                # shorter idents may be found at the same place too
+                for ident, position in self.markers.items():
+                    if position < best and found.startswith(ident):
+                        best = position
+
+        for position in self.generic:
+            if position >= best:
+                break
+            if self.builders[position].appropriate_key(name, \
+                                                chunk=chunk, obj=obj):
+                best = position
+                break
+        return best
+
+
+def module_exists(module_name):
+    """Whether module can be found, errors raised by the module itself
+    aren't hidden"""
+    if module_name in sys.modules:
+        return True
+    package_name, _, name = module_name.rpartition('.')
+    if not package_name:
+        try:
+            imp.find_module(name)
+        except ImportError:
+            return False
+        return True
+    try:
+        package = import_module(package_name)
+    except ImportError:
+        if module_exists(package_name):
+            raise
+        return False
+    return module_has_submodule(package, name)
+
+
+def import_builder(path):
+    """Return builder class by `package.module.ClassName` path"""
+    module_name, cls_name = path.rsplit('.', 1)
+    try:
+        module = import_module(module_name)
+    except ImportError:
+        # paths used to start with name of project package which isn't
+        # importable itself, but broken builder modules must not vanish
+        if '.' not in module_name or module_exists(module_name):
+            raise
+        module = import_module(module_name.split('.', 1)[1])
+    return getattr(module, cls_name)
+
+
+def invalidating_models(builders):
+    """Return labels of models which invalidate cache of any of
+    `builders`"""
+    return set(model_label(model) for builder in builders \
+               for model in builder.cache_invalidate_on)
+
+
+class BuilderRegistry(object):
+    """
+    Builders listed in CHUNK_BUILDERS setting followed by default builder.
+    They are imported and instantiated on first use, not when chunks
+    models are imported. Time spent on loading of each builder is kept in
+    `load_times`, see `load_report`.
+
+    Saves and deletes of `cache_invalidate_on` models cleanup builders
+    cache in every process connected with `connect`. Labels of the models
+    are stored in cache by processes which loaded builders, so the others
+    check saved models against them and don't load builders.
+    """
+    def __init__(self, paths):
+        self.paths = list(paths)
+        self.load_times = []
+        self.invalidating_models = None
+        self._index = None
+        self._lock = threading.Lock()
+        self._stored = 0
+
+    @property
+    def index(self):
+        index = self._index
+        if index is None:
+            with self._lock:
+                if self._index is None:
+                    self._index = self._load()
+                    logger.debug(self.load_report())
+                index = self._index
+        if time.time() - self._stored > INVALIDATING_MODELS_REFRESH:
+            self.store_invalidating_models()
+        return index
+
+    def _load(self):
+        builders = []
+        load_times = []
+        for path in self.paths:
+            started = time.time()
+            builders.append(import_builder(path)())
+            load_times.append((path, time.time() - started))
+        builders.append(ChunkBuilder())
+        self.load_times = load_times
+        labels = invalidating_models(builders)
+        for label in labels:
+            if get_model(*label.split('.')) is None:
+                logger.warning(u"Unknown model %s in cache_invalidate_on" % \
+                               label)
+        self.invalidating_models = labels
+        return BuilderIndex(builders)
+
+    def store_invalidating_models(self):
+        self._stored = time.time()
+        cache.set(INVALIDATING_MODELS_KEY, sorted(self.invalidating_models), \
+                  COUNTER_TIMEOUT)
+
+    def invalidates(self, label):
+        """Whether saves of model `label` invalidate builders cache. Until
+        builders are loaded, labels stored by other processes are used.
+        Nothing is stored if no process loaded them, so nothing is cached"""
+        labels = self.invalidating_models
+        if labels is None:
+            stored = cache.get(INVALIDATING_MODELS_KEY)
+            if stored is None:
+                return False
+            labels = self.invalidating_models = set(stored)
+        return label in labels
+
+    def model_changed(self, sender, instance, *args, **kwargs):
+        if self.invalidates(model_label(sender)):
+            from chunks.listeners import clear_builders_cache
+            clear_builders_cache(sender, instance)
+
+    def connect(self):
+        """Connect cleanup of builders cache to saves and deletes of all
+        models, it's checked by label whether they invalidate it"""
+        uid = 'chunks.builders.%s' % id(self)
+        post_save.connect(self.model_changed, dispatch_uid=uid)
+        pre_delete.connect(self.model_changed, dispatch_uid=uid)
+
+    def disconnect(self):
+        uid = 'chunks.builders.%s' % id(self)
+        post_save.disconnect(dispatch_uid=uid)
+        pre_delete.disconnect(dispatch_uid=uid)
+
+    @property
+    def loaded(self):
+        return self._index is not None
+
+    def resolve(self, name, chunk=None, obj=None):
+        return self.index.resolve(name, chunk=chunk, obj=obj)
+
+    def builder_by_ident(self, ident):
+        return self.index.builder_by_ident(ident)
+
+    def choices(self):
+        """Choices of builder type for forms"""
+        choices = [('', '')]
+        for builder in self.index.builders[:-1]:
+            ident = getattr(builder, u'ident', unicode(builder.__class__))
+            title = getattr(builder, u'title', unicode(builder.__class__))
+            choices.append((ident, title))
+        return choices
+
+    def load_report(self):
+        """Return text report of time spent on loading of builders, the
+        slowest first"""
+        lines = [u'%8.1f ms  %s' % (seconds * 1000, path) for path, seconds \
+                 in sorted(self.load_times, key=lambda i: -i[1])]
+        lines.append(u'%8.1f ms  total of %d builders' % (\
+                sum(seconds for path, seconds in self.load_times) * 1000, \
+                len(self.load_times)))
+        return u'\n'.join(lines)
+
+    def __iter__(self):
+        return iter(self.index.builders)
+
+    def __len__(self):
+        return len(self.index.builders)
+
+    def __getitem__(self, item):
+        return self.index.builders[item]
+
+
+# builders of all chunks, they are loaded on first use
+builders_registry = BuilderRegistry(getattr(settings, 'CHUNK_BUILDERS', []))
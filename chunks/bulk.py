@@ -0,0 +1,209 @@
+"""
+Bulk import and export of chunks used by `import_chunks` and
+`export_chunks` commands. Rows are dictionaries with FIELDS, `type` is
+`chunk` or `inline`, `model` (`app_label.modelname`), `object_id` and
+`order` are used by inline chunks only, `description` of inline chunk is
+its `desc`. Rows are streamed, so any number of chunks may be processed.
+"""
+import csv
+import json
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
+
+from chunks.caching import chunks_cache, bump_generation, bump_namespace, \
+                           IMPORTS_NAMESPACE
+from chunks.management.commands.warm_chunks import batches
+from chunks.models import Chunk, InlineChunk
+from chunks.search import update_index
+
+FIELDS = ('type', 'key', 'content', 'description', 'model', 'object_id',
+          'order')
+PLAIN = 'chunk'
+INLINE = 'inline'
+
+
+class Row(dict):
+    """Row read from file, `line` is its line number"""
+    line = None
+
+
+class InvalidRow(ValueError):
+    pass
+
+
+def export_rows(types=(PLAIN, INLINE)):
+    """Yield rows of all chunks of `types`"""
+    if PLAIN in types:
+        for c in Chunk.objects.order_by('key').iterator():
+            yield {'type': PLAIN, 'key': c.key, 'content': c.content,
+                   'description': c.description}
+    if INLINE in types:
+        chunks = InlineChunk.objects.order_by('content_type', 'object_id',
+                                              'order')
+        for ch in chunks.iterator():
+            model_type = ContentType.objects.get_for_id(ch.content_type_id)
+            yield {'type': INLINE, 'key': ch.key, 'content': ch.content,
+                   'description': ch.desc,
+                   'model': u'%s.%s' % (model_type.app_label,
+                                        model_type.model),
+                   'object_id': ch.object_id, 'order': ch.order}
+
+
+def write_rows(rows, stream, format='jsonl'):
+    """Write rows to file-like `stream` one by one, return their number"""
+    count = 0
+    if format == 'csv':
+        writer = csv.writer(stream)
+        writer.writerow(FIELDS)
+        for row in rows:
+            writer.writerow([unicode(row.get(field, u'')).encode('utf-8')
+                             for field in FIELDS])
+            count += 1
+    else:
+        for row in rows:
+            stream.write(json.dumps(row))
+            stream.write('\n')
+            count += 1
+    return count
+
+
+def read_rows(stream, format='jsonl'):
+    """Yield rows read from file-like `stream`"""
+    if format == 'csv':
+        reader = csv.DictReader(stream)
+        for row in reader:
+            row = Row((field, (value or '').decode('utf-8'))
+                      for field, value in row.items())
+            row.line = reader.line_num
+            yield row
+    else:
+        for number, line in enumerate(stream, 1):
+            if line.strip():
+                try:
+                    row = Row(json.loads(line))
+                except ValueError:
+                    raise InvalidRow(u"Line %d isn't valid JSON" % number)
+                row.line = number
+                yield row
+
+
+def check_row(row):
+    """Raise `InvalidRow` for row without key or with content or
+    description which isn't text"""
+    line = getattr(row, 'line', None)
+    key = row.get('key')
+    if not isinstance(key, basestring) or not key.strip():
+        raise InvalidRow(u"Missing key in line %s" % line)
+    for field in ('content', 'description'):
+        if not isinstance(row.get(field, u''), basestring):
+            raise InvalidRow(u"Invalid %s of %s in line %s" % \
+                             (field, key, line))
+
+
+def import_rows(rows, batch_size=500):
+    """
+    Create or update chunks from `rows`. Each batch is saved in one
+    transaction with one `bulk_create` for new chunks and `update` for
+    existing ones, cache and search index are updated once per batch.
+    Keys of plain chunks are normalized as `Chunk.save` does. Signals
+    aren't sent.
+    Returns numbers of created and updated chunks. `InvalidRow` is raised
+    for row without key, with content which isn't text or for inline
+    chunk of unknown object, previous batches stay saved.
+    """
+    created = updated = 0
+    for batch in batches(rows, batch_size):
+        plain = {}
+        inline = {}
+        for row in batch:
+            check_row(row)
+            if row.get('type', PLAIN) == INLINE:
+                try:
+                    app_label, model_name = row['model'].lower().split('.')
+                    model_type = ContentType.objects.get_by_natural_key(\
+                                                    app_label, model_name)
+                    object_id = int(row['object_id'])
+                except (KeyError, ValueError, ContentType.DoesNotExist):
+                    raise InvalidRow(u"Unknown object %s %s in line %s" % \
+                                     (row.get('model'), row.get('object_id'),
+                                      getattr(row, 'line', None)))
+                inline[(model_type.id, object_id, row['key'])] = row
+            else:
+                plain[Chunk.normalize_key(row['key'])] = row
+
+        with transaction.commit_on_success():
+            c, u = import_plain_chunks(plain)
+            created, updated = created + c, updated + u
+            c, u = import_inline_chunks(inline)
+            created, updated = created + c, updated + u
+
+        invalidate(plain, inline)
+    return created, updated
+
+
+def import_plain_chunks(rows):
+    existing = dict(Chunk.objects.filter(key__in=rows.keys())\
+                                 .values_list('key', 'id'))
+    new_chunks = []
+    for key, row in rows.items():
+        values = {'content': row.get('content', u''),
+                  'description': row.get('description', u'')}
+        if key in existing:
+            Chunk.objects.filter(id=existing[key]).update(**values)
+        else:
+            new_chunks.append(Chunk(key=key, **values))
+    Chunk.objects.bulk_create(new_chunks)
+    update_index(Chunk, Chunk.objects.filter(key__in=rows.keys()))
+    return len(new_chunks), len(existing)
+
+
+def import_inline_chunks(rows):
+    objects = {}
+    for model_type_id, object_id, key in rows:
+        objects.setdefault(model_type_id, set()).add(object_id)
+    keys = set(i[2] for i in rows)
+    existing = {}
+    for model_type_id, object_ids in objects.items():
+        chunks = InlineChunk.objects.filter(content_type=model_type_id,
+                                            object_id__in=object_ids,
+                                            key__in=keys)
+        for chunk_id, object_id, key in \
+                chunks.values_list('id', 'object_id', 'key'):
+            existing[(model_type_id, object_id, key)] = chunk_id
+
+    new_chunks = []
+    updated = 0
+    for (model_type_id, object_id, key), row in rows.items():
+        values = {'content': row.get('content', u''),
+                  'desc': row.get('description', u''),
+                  'order': int(row.get('order') or 0)}
+        chunk_id = existing.get((model_type_id, object_id, key))
+        if chunk_id is not None:
+            InlineChunk.objects.filter(id=chunk_id).update(**values)
+            updated += 1
+        else:
+            new_chunks.append(InlineChunk(content_type_id=model_type_id,
+                                          object_id=object_id, key=key,
+                                          **values))
+    InlineChunk.objects.bulk_create(new_chunks)
+    # only imported chunks are indexed, they are loaded if index is used
+    imported = (ch for model_type_id, object_ids in objects.items()
+                for ch in InlineChunk.objects.filter(\
+                        content_type=model_type_id, object_id__in=object_ids,
+                        key__in=keys)
+                if (model_type_id, ch.object_id, ch.key) in rows)
+    update_index(InlineChunk, imported)
+    return len(new_chunks), updated
+
+
+def invalidate(plain, inline):
+    """Cleanup cache of imported chunks with a few cache calls whatever
+    the size of batch: cached plain chunks are deleted at once, chunks of
+    all objects and all cached pages are invalidated by imports namespace"""
+    if not (plain or inline):
+        return
+    if plain:
+        chunks_cache.delete_many([Chunk.cache_key(key) for key in plain])
+    bump_namespace(IMPORTS_NAMESPACE)
+    bump_generation()
@@ -0,0 +1,432 @@
+"""Cache helpers shared by chunks models, listeners and template tags"""
+import cPickle as pickle
+import hashlib
+import random
+import re
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+
+GENERATION_KEY = 'chunks_generation'
+OBJECTS_GENERATION_KEY = 'chunks_objects_generation'
+NAMESPACE_PREFIX = 'chunks_ns_'
+# namespace bumped whenever cached output of any builder is dropped, pages
+# cached by `ChunksPageCacheMiddleware` depend on it
+BUILDERS_NAMESPACE = 'builders'
+# namespace bumped once per batch of `import_chunks`, chunks of all objects
+# and pages cached by `ChunksPageCacheMiddleware` depend on it
+IMPORTS_NAMESPACE = 'imports'
+CHUNK_VERSION_PREFIX = 'chunks_version_'
+# longest timeout memcached accepts as relative one
+COUNTER_TIMEOUT = 60 * 60 * 24 * 30
+# keys which can't be used with memcached as is
+UNSAFE_KEY_RE = re.compile(r'[^\x21-\x7e]')
+MAX_KEY_LENGTH = 200
+
+
+def initial_generation():
+    """Counters are started from current time, so counter which was
+    evicted from cache never repeats numbers it has already given out"""
+    return int(time.time() * 1000)
+
+
+def get_counters(names, backend=cache):
+    """Return dictionary with values of counters, missing counters
+    are started"""
+    counters = backend.get_many(names)
+    missing = [name for name in names if name not in counters]
+    if missing:
+        for name in missing:
+            cache.add(name, initial_generation(), COUNTER_TIMEOUT)
+        counters.update(backend.get_many(missing))
+    return counters
+
+
+def bump_counter(name):
+    try:
+        return cache.incr(name)
+    except ValueError:
+        # counter is expired or evicted
+        value = initial_generation()
+        cache.set(name, value, COUNTER_TIMEOUT)
+        return value
+
+
+def get_generation():
+    """Return global generation number of chunks. It is changed each time
+    any chunk is saved or deleted"""
+    return get_counters([GENERATION_KEY])[GENERATION_KEY]
+
+
+def bump_generation():
+    """Invalidate everything built from the chunks table as a whole"""
+    return bump_counter(GENERATION_KEY)
+
+
+def chunk_version_key(key):
+    """Name of counter which is changed each time chunk is saved"""
+    return safe_key(CHUNK_VERSION_PREFIX, key)
+
+
+def bump_chunk_version(key):
+    return bump_counter(chunk_version_key(key))
+
+
+def namespace_versions(namespaces):
+    """Return list of current versions of provided namespaces"""
+    names = [NAMESPACE_PREFIX + ns for ns in namespaces]
+    counters = get_counters(names, backend=chunks_cache)
+    return [counters[name] for name in names]
+
+
+def bump_namespace(namespace):
+    """Invalidate all keys built by `versioned_key` with namespace"""
+    name = NAMESPACE_PREFIX + namespace
+    bump_counter(name)
+    if local_cache is not None:
+        local_cache.delete(name)
+    # let other processes drop their local copies
+    bump_counter(OBJECTS_GENERATION_KEY)
+
+
+def hashed_key(prefix, *parts):
+    """Build cache key of fixed length from any parts"""
+    raw = u':'.join(unicode(part) for part in parts)
+    return prefix + hashlib.md5(raw.encode('utf-8')).hexdigest()
+
+
+def safe_key(prefix, key):
+    """Return `prefix` + `key` if it's acceptable cache key or hashed
+    key otherwise"""
+    cache_key = prefix + key
+    if len(cache_key) > MAX_KEY_LENGTH or UNSAFE_KEY_RE.search(cache_key):
+        return hashed_key(prefix + 'hash_', key)
+    return cache_key
+
+
+def versioned_key(prefix, namespaces, *parts, **kwargs):
+    """Build cache key which is changed each time any of `namespaces`
+    is bumped. Current `versions` of namespaces may be passed if they
+    are known already"""
+    versions = kwargs.get('versions')
+    if versions is None:
+        versions = namespace_versions(namespaces)
+    return hashed_key(prefix, *(list(namespaces) + versions + list(parts)))
+
+
+# prefixes of values encoded by `encode_value`, the last byte is format.
+# Values stored by previous versions can't start with NUL byte and magic
+ENCODED_MAGIC = '\x00chunks'
+PICKLED_FORMAT = ENCODED_MAGIC + 'p'
+COMPRESSED_FORMAT = ENCODED_MAGIC + 'z'
+RECORD_TAG = 'chunks:record'
+RECORD_FIELDS = ('id', 'key', 'content', 'description')
+
+
+def compact(value):
+    """Replace records of chunks (see `chunks.models.chunk_record`)
+    with tuples without field names"""
+    if isinstance(value, tuple) and len(value) == 3 \
+            and value[0] == STALE_MARKER:
+        return value[:2] + (compact(value[2]),)
+    if isinstance(value, dict) and len(value) == len(RECORD_FIELDS) \
+            and all(field in value for field in RECORD_FIELDS):
+        return (RECORD_TAG,) + tuple(value[field] for field in RECORD_FIELDS)
+    return value
+
+
+def expand(value):
+    if isinstance(value, tuple) and len(value) == 3 \
+            and value[0] == STALE_MARKER:
+        return value[:2] + (expand(value[2]),)
+    if isinstance(value, tuple) and len(value) == len(RECORD_FIELDS) + 1 \
+            and value[0] == RECORD_TAG:
+        return dict(zip(RECORD_FIELDS, value[1:]))
+    return value
+
+
+def encode_value(value, compress_threshold=None):
+    """Return compact string with `value` which is zlib compressed if it's
+    longer than `compress_threshold` bytes"""
+    data = pickle.dumps(compact(value), pickle.HIGHEST_PROTOCOL)
+    if compress_threshold and len(data) > compress_threshold:
+        compressed = zlib.compress(data)
+        if len(compressed) < len(data):
+            return COMPRESSED_FORMAT + compressed
+    return PICKLED_FORMAT + data
+
+
+def decode_value(value):
+    """Return value encoded by `encode_value`. Values stored before
+    encoding was added are returned as is"""
+    if isinstance(value, str) and value.startswith(ENCODED_MAGIC):
+        if value.startswith(PICKLED_FORMAT):
+            return expand(pickle.loads(value[len(PICKLED_FORMAT):]))
+        if value.startswith(COMPRESSED_FORMAT):
+            return expand(pickle.loads(zlib.decompress(\
+                                        value[len(COMPRESSED_FORMAT):])))
+    return value
+
+
+class LocalCache(object):
+    """
+    Bounded per-process LRU cache with TTL. Whole cache is dropped when
+    any chunk or chunks namespace is changed, it's checked not more
+    often than once per `staleness` seconds.
+    """
+    def __init__(self, size, timeout=60, staleness=1):
+        self.size = size
+        self.timeout = timeout
+        self.staleness = staleness
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = None
+        self._checked = 0
+
+    def validate(self):
+        now = time.time()
+        if now - self._checked < self.staleness:
+            return
+        self._checked = now
+        counters = get_counters([GENERATION_KEY, OBJECTS_GENERATION_KEY])
+        generation = (counters[GENERATION_KEY],
+                      counters[OBJECTS_GENERATION_KEY])
+        if generation != self._generation:
+            with self._lock:
+                self._data.clear()
+                self._generation = generation
+
+    def get(self, key, default=None):
+        self.validate()
+        with self._lock:
+            item = self._data.pop(key, None)
+            if item is None or item[1] < time.time():
+                self.misses += 1
+                return default
+            # move to the end as most recently used
+            self._data[key] = item
+            self.hits += 1
+            return item[0]
+
+    def set(self, key, value, timeout=None):
+        if not timeout or timeout > self.timeout:
+            timeout = self.timeout
+        self.validate()
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (value, time.time() + timeout)
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'size': len(self._data),
+               }
+
+
+class ChunksCache(object):
+    """
+    Django cache with optional in-process `LocalCache` in front of it.
+
+    If `stale_time` is set, values are stored with soft expiration time and
+    are kept in cache `stale_time` seconds longer. When value is expired
+    softly only one process gets a miss and rebuilds it (it holds short
+    lock in cache), the others keep serving the stale value meanwhile.
+    `jitter` is fraction of timeout randomly added to it, so values
+    written together don't expire together.
+
+    If `encode` is set, values are stored in Django cache in compact format
+    of `encode_value` and those longer than `compress_threshold` bytes are
+    compressed. Local cache keeps decoded values.
+    """
+    # values of `set_many` get one of this number of jittered timeouts
+    JITTER_BUCKETS = 4
+
+    def __init__(self, backend, local=None, stale_time=None, \
+                 lock_timeout=10, jitter=0, encode=False, \
+                 compress_threshold=None):
+        self.backend = backend
+        self.local = local
+        self.stale_time = stale_time
+        self.lock_timeout = lock_timeout
+        self.jitter = jitter
+        self.encode = encode
+        self.compress_threshold = compress_threshold
+
+    def _encode(self, value):
+        if not self.encode:
+            return value
+        return encode_value(value, self.compress_threshold)
+
+    def _get(self, key):
+        if self.local is None:
+            return decode_value(self.backend.get(key, _missing))
+
+        value = self.local.get(key, _missing)
+        if value is _missing:
+            value = decode_value(self.backend.get(key, _missing))
+            if value is not _missing:
+                self.local.set(key, value)
+        return value
+
+    def _get_many(self, keys):
+        if self.local is None:
+            return dict((key, decode_value(value)) for key, value \
+                        in self.backend.get_many(keys).items())
+
+        values = {}
+        missing = []
+        for key in keys:
+            value = self.local.get(key, _missing)
+            if value is _missing:
+                missing.append(key)
+            else:
+                values[key] = value
+        if missing:
+            for key, value in self.backend.get_many(missing).items():
+                value = decode_value(value)
+                self.local.set(key, value)
+                values[key] = value
+        return values
+
+    def _unpack(self, key, value):
+        """Return stored value or `_missing` if caller should rebuild it"""
+        if not (isinstance(value, tuple) and len(value) == 3 \
+                    and value[0] == STALE_MARKER):
+            return value
+        marker, soft_expires, value = value
+        if soft_expires < time.time() and \
+                self.backend.add(key + ':lock', 1, self.lock_timeout):
+            # this process rebuilds the value, the others get stale one
+            return _missing
+        return value
+
+    def _pack(self, value, timeout):
+        """Return value to store and its hard timeout"""
+        if timeout and self.jitter:
+            timeout += random.randint(0, int(timeout * self.jitter))
+        if not timeout or self.stale_time is None:
+            return value, timeout
+        return (STALE_MARKER, time.time() + timeout, value), \
+                    timeout + self.stale_time
+
+    def get(self, key, default=None):
+        value = self._get(key)
+        if value is not _missing:
+            value = self._unpack(key, value)
+        if value is _missing:
+            return default
+        return value
+
+    def get_many(self, keys):
+        values = {}
+        for key, value in self._get_many(keys).items():
+            value = self._unpack(key, value)
+            if value is not _missing:
+                values[key] = value
+        return values
+
+    def set(self, key, value, timeout=None):
+        value, timeout = self._pack(value, timeout)
+        self.backend.set(key, self._encode(value), timeout)
+        if self.local is not None:
+            self.local.set(key, value, timeout)
+
+    def set_many(self, data, timeout=None):
+        if self.stale_time is not None and timeout:
+            # soft expiration time is jittered per value
+            packed = {}
+            for key, value in data.items():
+                packed[key] = self._pack(value, timeout)[0]
+            timeout = int(timeout * (1 + self.jitter)) + self.stale_time
+            self._set_many(packed, timeout)
+        elif timeout and self.jitter:
+            # values are spread over a few timeouts, one call for each
+            spread = int(timeout * self.jitter)
+            steps = max(self.JITTER_BUCKETS - 1, 1)
+            buckets = {}
+            for key, value in data.items():
+                step = random.randint(0, steps)
+                buckets.setdefault(timeout + spread * step // steps, {})\
+                        [key] = value
+            for bucket_timeout, values in buckets.items():
+                self._set_many(values, bucket_timeout)
+        else:
+            self._set_many(data, timeout)
+
+    def _set_many(self, data, timeout):
+        self.backend.set_many(dict((key, self._encode(value)) \
+                              for key, value in data.items()), timeout)
+        if self.local is not None:
+            for key, value in data.items():
+                self.local.set(key, value, timeout)
+
+    def delete(self, key):
+        self.backend.delete(key)
+        if self.local is not None:
+            self.local.delete(key)
+
+    def delete_many(self, keys):
+        self.backend.delete_many(keys)
+        if self.local is not None:
+            for key in keys:
+                self.local.delete(key)
+
+
+_missing = object()
+STALE_MARKER = 'chunks:stale'
+# cached instead of chunk which doesn't exist
+ABSENT = ('chunks:absent',)
+ABSENT_CACHE_TIME = getattr(settings, 'CHUNKS_ABSENT_CACHE_TIME', 60)
+
+LOCAL_CACHE_SIZE = getattr(settings, 'CHUNKS_LOCAL_CACHE_SIZE', 0)
+LOCAL_CACHE_TIMEOUT = getattr(settings, 'CHUNKS_LOCAL_CACHE_TIMEOUT', 60)
+LOCAL_CACHE_STALENESS = getattr(settings, 'CHUNKS_LOCAL_CACHE_STALENESS', 1)
+
+local_cache = None
+if LOCAL_CACHE_SIZE:
+    local_cache = LocalCache(LOCAL_CACHE_SIZE, \
+                             timeout=LOCAL_CACHE_TIMEOUT, \
+                             staleness=LOCAL_CACHE_STALENESS)
+
+STALE_TIME = None
+if getattr(settings, 'CHUNKS_STAMPEDE_PROTECTION', False):
+    STALE_TIME = getattr(settings, 'CHUNKS_STALE_TIME', 60)
+LOCK_TIMEOUT = getattr(settings, 'CHUNKS_LOCK_TIMEOUT', 10)
+CACHE_JITTER = getattr(settings, 'CHUNKS_CACHE_JITTER', 0)
+# encoded values are always read, so turn it on when all processes run
+# version which reads them
+COMPACT_VALUES = getattr(settings, 'CHUNKS_COMPACT_VALUES', False)
+COMPRESS_THRESHOLD = getattr(settings, 'CHUNKS_COMPRESS_THRESHOLD', None)
+
+# cache for rendered chunks
+chunks_cache = ChunksCache(cache, local=local_cache, stale_time=STALE_TIME, \
+                           lock_timeout=LOCK_TIMEOUT, jitter=CACHE_JITTER, \
+                           encode=COMPACT_VALUES, \
+                           compress_threshold=COMPRESS_THRESHOLD)
+
+
+def local_cache_stats():
+    """Return hit, miss and eviction counters of in-process cache
+    or None if it's disabled"""
+    if local_cache is None:
+        return None
+    return local_cache.stats()
@@ -1,8 +1,63 @@
-from chunks.models import Chunk
+import threading
+
+from chunks.caching import get_generation
+from chunks.models import chunk_storage
+from chunks.tracking import track_all_chunks_dependency
+
+# (generation, {key: content}) shared by all requests of the process
+_snapshot = (None, {})
+_snapshot_lock = threading.Lock()
+
+
+def chunks_snapshot():
+    """Return dictionary with content of all chunks. It is rebuilt only
+    when chunks generation is changed"""
+    global _snapshot
+    generation = get_generation()
+    if _snapshot[0] != generation:
+        with _snapshot_lock:
+            if _snapshot[0] != generation:
+                chunks_dict = dict(chunk_storage().all_chunks())
+                _snapshot = (generation, chunks_dict)
+    return _snapshot[1]
+
+
+class LazyChunks(object):
+    """Read-only mapping of chunk keys to their content. Nothing is loaded
+    until the mapping is accessed"""
+    def __init__(self):
+        self._chunks = None
+
+    def _load(self):
+        track_all_chunks_dependency()
+        if self._chunks is None:
+            self._chunks = chunks_snapshot()
+        return self._chunks
+
+    def __getitem__(self, key):
+        return self._load()[key]
+
+    def __contains__(self, key):
+        return key in self._load()
+
+    def __iter__(self):
+        return iter(self._load())
+
+    def __len__(self):
+        return len(self._load())
+
+    def get(self, key, default=None):
+        return self._load().get(key, default)
+
+    def keys(self):
+        return self._load().keys()
+
+    def values(self):
+        return self._load().values()
+
+    def items(self):
+        return self._load().items()
 
 
 def chunks(request):
-    chunks_dict = {}
-    for c in Chunk.objects.all():
-        chunks_dict[c.key] = c.content
-    return {"CHUNKS": chunks_dict}
+    return {"CHUNKS": LazyChunks()}
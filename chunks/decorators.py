@@ -0,0 +1,17 @@
+from django.utils.decorators import decorator_from_middleware_with_args
+
+from chunks.middleware import ChunksPageCacheMiddleware
+
+
+def chunks_cache_page(cache_timeout=None, key_prefix=''):
+    """
+    Cache view like `django.views.decorators.cache.cache_page` does, but
+    until any chunk used by the page is changed, see
+    `chunks.middleware.ChunksPageCacheMiddleware`.
+
+        @chunks_cache_page(60 * 60)
+        def page(request, slug):
+            ...
+    """
+    return decorator_from_middleware_with_args(ChunksPageCacheMiddleware)(\
+                    cache_timeout=cache_timeout, key_prefix=key_prefix)
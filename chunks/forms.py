@@ -4,21 +4,17 @@ from django.utils.translation import ugettext_lazy as _
 from models import InlineChunk, CHUNK_BUILDERS
 
 
-CHUNK_BUILDERS_CHOICES = [('', '')]
-
-for bldr in CHUNK_BUILDERS[:-1]:
-    ident = getattr(bldr, u'ident', unicode(bldr.__class__))
-    title = getattr(bldr, u'title', unicode(bldr.__class__))
-    CHUNK_BUILDERS_CHOICES.append((ident, title))
-
-
 class InlineChunkForm(forms.ModelForm):
     chunk_type = forms.ChoiceField(label=_(u"Chunk Type"), \
-                                   choices=CHUNK_BUILDERS_CHOICES, \
                                    required=False, \
                                    widget=forms.Select(\
                                         attrs={'class': 'chunks-type'}))
 
+    def __init__(self, *args, **kwargs):
+        super(InlineChunkForm, self).__init__(*args, **kwargs)
+        # builders are loaded when the form is used first time
+        self.fields['chunk_type'].choices = CHUNK_BUILDERS.choices()
+
     class Meta:
         model = InlineChunk
 
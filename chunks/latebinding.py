@@ -0,0 +1,252 @@
+"""
+Late binding of chunks: with CHUNKS_LATE_BINDING set, `chunk` and
+`object_chunk` tags output placeholders while `ChunksMiddleware` handles
+a request and it replaces them with chunks when response is ready.
+Templates rendered elsewhere (emails, commands) and for AJAX requests
+get chunks inline. So rendered pages may be cached
+by view or template fragment cache regardless of chunk edits.
+
+Placeholders are signed with SECRET_KEY, so the ones which come with user
+content aren't replaced. Malformed or unknown placeholders are left as is.
+"""
+import re
+import threading
+import urllib
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.utils.crypto import salted_hmac, constant_time_compare
+
+from chunks.caching import chunks_cache, namespace_versions, \
+                           ABSENT, ABSENT_CACHE_TIME
+from chunks.models import chunk_storage, cacheable_content, \
+                          cached_content, object_chunks_namespaces, \
+                          object_chunk_cache_key
+
+# chunk:c:<cache time>:<key>:<signature> or
+# chunk:o:<cache time>:<app label>:<model>:<object id>:<key>:<default>:<sign.>
+PLACEHOLDER_RE = re.compile(r'<!--chunk:(c:\d+:[^:>]*|'
+                            r'o:\d+:\w+:\w+:\d+:[^:>]*:[^:>]*)'
+                            r':([0-9a-f]{16})-->')
+
+
+_local = threading.local()
+
+
+def start_late_binding():
+    """Output placeholders in current thread until `stop_late_binding`,
+    it's called by `ChunksMiddleware` for requests it resolves"""
+    _local.enabled = True
+
+
+def stop_late_binding():
+    _local.enabled = False
+
+
+def late_binding_enabled():
+    """Placeholders are never used while chunks are wrapped for editing"""
+    return getattr(settings, 'CHUNKS_LATE_BINDING', False) \
+        and not getattr(settings, 'CHUNKS_WRAP', False)
+
+
+def placeholders_enabled():
+    """Whether chunk tags output placeholders, only when they are going to
+    be resolved"""
+    return getattr(_local, 'enabled', False) and late_binding_enabled()
+
+
+def quote(value):
+    return urllib.quote(value.encode('utf-8'), safe='')
+
+
+def unquote(value):
+    return urllib.unquote(value).decode('utf-8')
+
+
+def sign(payload):
+    return salted_hmac('chunks.latebinding', payload).hexdigest()[:16]
+
+
+def placeholder(payload):
+    return '<!--chunk:%s:%s-->' % (payload, sign(payload))
+
+
+def chunk_placeholder(key, cache_time):
+    """Placeholder of `chunk` tag"""
+    return placeholder('c:%d:%s' % (int(cache_time), quote(key)))
+
+
+def object_chunk_placeholder(obj, key, cache_time, default_chunk=None):
+    """Placeholder of `object_chunk` tag, `obj` must be saved"""
+    return placeholder('o:%d:%s:%s:%d:%s:%s' % (int(cache_time), \
+                obj._meta.app_label, obj._meta.object_name.lower(), \
+                obj.pk, quote(key), quote(default_chunk or u'')))
+
+
+def parse_placeholder(match):
+    """Return ('c', key, cache_time) or ('o', (app_label, model_name,
+    object_id, key), cache_time, default) for `match` of PLACEHOLDER_RE,
+    None if it isn't valid"""
+    payload, signature = match.groups()
+    if not constant_time_compare(sign(payload), signature):
+        return None
+    parts = payload.split(':')
+    try:
+        if parts[0] == 'c':
+            return 'c', unquote(parts[2]), int(parts[1])
+        app_label, model_name = parts[2], parts[3]
+        ContentType.objects.get_by_natural_key(app_label, model_name)
+        return 'o', (app_label, model_name, int(parts[4]), \
+                     unquote(parts[5])), int(parts[1]), unquote(parts[6])
+    except (UnicodeDecodeError, ContentType.DoesNotExist):
+        return None
+
+
+def resolve_placeholders(content, request):
+    """Replace all placeholders in `content` with chunks. Chunks are
+    fetched with one `get_many` for plain chunks and one for inline ones,
+    cache misses are loaded with one query for each"""
+    from chunks.templatetags.chunks import fetch_chunks, render_chunk
+
+    plain = {}
+    objects = {}
+    parsed = {}
+    for match in PLACEHOLDER_RE.finditer(content):
+        if match.group(0) in parsed:
+            continue
+        item = parsed[match.group(0)] = parse_placeholder(match)
+        if item is None:
+            continue
+        if item[0] == 'c':
+            plain.setdefault(item[1], item[2])
+        else:
+            objects.setdefault(item[1], item[2:])
+    if not plain and not objects:
+        return content
+
+    context = {'request': request}
+    resolved = {}
+    records = fetch_chunks(context, plain)
+    for key, cache_time in plain.items():
+        resolved[('c', key)] = render_chunk(context, key, False, \
+                                    cache_time, record=records.get(key))
+    for item, value in resolve_object_chunks(objects, request, \
+                                             context).items():
+        resolved[('o',) + item] = value
+
+    def replace(match):
+        item = parsed[match.group(0)]
+        if item is None:
+            return match.group(0)
+        if item[0] == 'c':
+            key = ('c', item[1])
+        else:
+            key = ('o',) + item[1]
+        value = resolved.get(key, u'')
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        return value
+
+    return PLACEHOLDER_RE.sub(replace, content)
+
+
+def resolve_object_chunks(items, request, context):
+    """Return content of inline chunks for `items` which map
+    (app_label, model_name, object_id, key) to (cache_time, default_chunk)"""
+    from chunks.templatetags.chunks import fetch_chunks
+
+    if not items:
+        return {}
+    # versions of all objects are read at once
+    objects = sorted(set(item[:3] for item in items))
+    all_namespaces = []
+    for app_label, model_name, object_id in objects:
+        all_namespaces.extend(object_chunks_namespaces(app_label, \
+                                                model_name, object_id))
+    versions = namespace_versions(all_namespaces)
+    size = len(all_namespaces) // len(objects)
+    positions = dict((obj, i * size) for i, obj in enumerate(objects))
+    cache_keys = {}
+    for item in items:
+        i = positions[item[:3]]
+        cache_keys[item] = object_chunk_cache_key(\
+                                all_namespaces[i:i + size], item[3], \
+                                versions=versions[i:i + size])
+
+    cached = chunks_cache.get_many(cache_keys.values())
+    values = {}
+    missing = []
+    for item, cache_key in cache_keys.items():
+        if cache_key in cached:
+            values[item] = cached[cache_key]
+        else:
+            missing.append(item)
+
+    parents = {}
+    if missing:
+        parents = load_objects(set(item[:3] for item in missing))
+        pairs = {}
+        for app_label, model_name, object_id, key in missing:
+            model_type = ContentType.objects\
+                            .get_by_natural_key(app_label, model_name)
+            pairs[(model_type.id, object_id)] = (app_label, model_name)
+        found = {}
+        for (model_type_id, object_id), object_chunks in chunk_storage()\
+                .inline_chunks(pairs.keys(), \
+                               keys=set(item[3] for item in missing)).items():
+            app_label, model_name = pairs[(model_type_id, object_id)]
+            for ch in object_chunks:
+                found[(app_label, model_name, object_id, ch.key)] = ch
+
+        defaults = dict((items[item][1], items[item][0]) \
+                        for item in missing \
+                        if item not in found and items[item][1])
+        default_records = fetch_chunks(context, defaults)
+
+        to_cache = {}
+        for item in missing:
+            cache_time, default = items[item]
+            if item in found:
+                value = cacheable_content(found[item], request, context, \
+                                          obj=parents.get(item[:3]))
+            elif default_records.get(default, ABSENT) != ABSENT:
+                value = default_records[default]['content']
+            else:
+                value = ABSENT
+                cache_time = ABSENT_CACHE_TIME
+            values[item] = value
+            to_cache.setdefault(int(cache_time), {})[cache_keys[item]] = value
+        for cache_time, entries in to_cache.items():
+            chunks_cache.set_many(entries, cache_time)
+
+    result = {}
+    for item, value in values.items():
+        if value == ABSENT:
+            result[item] = u''
+            continue
+        obj = None
+        if isinstance(value, tuple):
+            # output of builders varying on request needs the object
+            if item[:3] not in parents:
+                parents.update(load_objects([item[:3]]))
+            obj = parents.get(item[:3])
+        result[item] = cached_content(value, request, context, obj=obj)
+    return result
+
+
+def load_objects(objects):
+    """Load objects by (app_label, model_name, object_id) with one query
+    for each model"""
+    ids = {}
+    for app_label, model_name, object_id in objects:
+        ids.setdefault((app_label, model_name), []).append(object_id)
+    loaded = {}
+    for (app_label, model_name), object_ids in ids.items():
+        model = ContentType.objects\
+                    .get_by_natural_key(app_label, model_name).model_class()
+        if model is None:
+            continue
+        for object_id, obj in model._default_manager\
+                                .in_bulk(object_ids).items():
+            loaded[(app_label, model_name, object_id)] = obj
+    return loaded
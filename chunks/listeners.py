@@ -1,3 +1,10 @@
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+
+from chunks.builders import model_label
+from chunks.caching import bump_generation, bump_namespace, \
+                           bump_chunk_version, BUILDERS_NAMESPACE
+from chunks.search import create_index, update_index, remove_from_index
 
 
 def clear_chunks_cache(sender, instance, *args, **kwargs):
@@ -11,3 +18,62 @@ def clear_chunks_cache(sender, instance, *args, **kwargs):
 def clear_plain_chunk_cache(sender, instance, *args, **kwargs):
     """Cleanup simple chunk cache when chunk is updated"""
     instance.clear_cache()
+
+
+def clear_inline_chunk_cache(sender, instance, *args, **kwargs):
+    """Cleanup chunks cache of object when its inline chunk is updated"""
+    instance.clear_cache()
+
+
+def refresh_plain_chunk_cache(sender, instance, *args, **kwargs):
+    """Put saved chunk into cache if CHUNKS_WRITE_THROUGH is set,
+    otherwise cleanup its cache"""
+    if getattr(settings, 'CHUNKS_WRITE_THROUGH', False):
+        instance.refresh_cache()
+    else:
+        instance.clear_cache()
+
+
+def refresh_inline_chunk_cache(sender, instance, *args, **kwargs):
+    """Put chunks of object into cache when its inline chunk is saved if
+    CHUNKS_WRITE_THROUGH is set, otherwise cleanup their cache"""
+    if getattr(settings, 'CHUNKS_WRITE_THROUGH', False):
+        instance.refresh_cache()
+    else:
+        instance.clear_cache()
+
+
+def bump_chunks_generation(sender, instance, *args, **kwargs):
+    """Invalidate everything built from all chunks at once, e.g. snapshot
+    used by `chunks.context_processors.chunks`"""
+    bump_generation()
+
+
+def invalidate_chunk_pages(sender, instance, *args, **kwargs):
+    """Invalidate pages cached with `ChunksPageCacheMiddleware` which
+    use the chunk"""
+    bump_chunk_version(instance.key)
+
+
+def clear_builders_cache(sender, instance, *args, **kwargs):
+    """Cleanup output of builders which depend on saved model, see
+    `ChunkBuilder.cache_invalidate_on`. Called for these models by
+    `chunks.builders.BuilderRegistry.model_changed`"""
+    bump_namespace(u'model.%s' % model_label(sender))
+    bump_namespace(BUILDERS_NAMESPACE)
+
+
+def index_chunk(sender, instance, using=DEFAULT_DB_ALIAS, *args, **kwargs):
+    """Update search index of saved chunk or inline chunk"""
+    update_index(sender, [instance], using)
+
+
+def unindex_chunk(sender, instance, using=DEFAULT_DB_ALIAS, *args, **kwargs):
+    """Remove deleted chunk or inline chunk from search index"""
+    remove_from_index(sender, [instance.pk], using)
+
+
+def create_search_index(sender, db=DEFAULT_DB_ALIAS, *args, **kwargs):
+    """Create search index tables by syncdb"""
+    if sender.__name__ == 'chunks.models':
+        create_index([sender.Chunk, sender.InlineChunk], db)
@@ -0,0 +1,63 @@
+import time
+from optparse import make_option
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import BaseCommand, CommandError
+
+from chunks.caching import chunks_cache, bump_generation, bump_namespace, \
+                           bump_chunk_version
+from chunks.models import Chunk, object_chunks_namespaces
+from chunks.storage import Snapshot, snapshot_entries, write_snapshot, \
+                           PLAIN_PREFIX, OBJECT_ID
+
+
+class Command(BaseCommand):
+    help = "Build snapshot of all chunks read by SnapshotStorage and " \
+           "publish it atomically"
+
+    option_list = BaseCommand.option_list + (
+        make_option('--output', dest='output',
+            default=getattr(settings, 'CHUNKS_SNAPSHOT_PATH', None),
+            help='Path of snapshot, CHUNKS_SNAPSHOT_PATH by default'),
+    )
+
+    def handle(self, *args, **options):
+        path = options['output']
+        if not path:
+            raise CommandError("Provide --output or CHUNKS_SNAPSHOT_PATH")
+        started = time.time()
+
+        try:
+            previous = dict(Snapshot(path).items())
+        except (IOError, ImproperlyConfigured):
+            previous = None
+
+        entries = list(snapshot_entries())
+        count = write_snapshot(path, entries)
+        if previous is not None:
+            self.invalidate(previous, dict(entries))
+
+        if int(options.get('verbosity', 1)):
+            self.stdout.write(u"Published snapshot of %d entries to %s "
+                              u"in %.2f seconds\n" % (count, path,
+                                                      time.time() - started))
+
+    def invalidate(self, previous, current):
+        """Cleanup cache of chunks changed since previous snapshot, it
+        may have been filled from the previous one"""
+        changed = [key for key in set(previous) | set(current) \
+                   if previous.get(key) != current.get(key)]
+        for key in changed:
+            if key.startswith(PLAIN_PREFIX):
+                chunk_key = key[len(PLAIN_PREFIX):].decode('utf-8')
+                chunks_cache.delete(Chunk.cache_key(chunk_key))
+                bump_chunk_version(chunk_key)
+            else:
+                model_type_id, object_id = OBJECT_ID.unpack(key[1:])
+                model_type = ContentType.objects.get_for_id(model_type_id)
+                bump_namespace(object_chunks_namespaces(model_type.app_label, \
+                                        model_type.model, object_id)[-1])
+        if changed:
+            bump_generation()
@@ -0,0 +1,42 @@
+import sys
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from chunks.bulk import export_rows, write_rows, PLAIN, INLINE
+
+
+class Command(BaseCommand):
+    help = "Export chunks and inline chunks as JSON Lines or CSV"
+
+    option_list = BaseCommand.option_list + (
+        make_option('--output', dest='output', default='-',
+            help='File to write chunks to, stdout by default'),
+        make_option('--format', dest='format', default=None,
+            help='jsonl or csv, by extension of output file by default'),
+        make_option('--type', dest='type', default='all',
+            help='chunk, inline or all (default)'),
+    )
+
+    def handle(self, *args, **options):
+        format = options['format'] or guess_format(options['output'])
+        if format not in ('jsonl', 'csv'):
+            raise CommandError("Unknown format %s" % format)
+        types = (PLAIN, INLINE)
+        if options['type'] != 'all':
+            types = (options['type'],)
+
+        rows = export_rows(types)
+        if options['output'] == '-':
+            count = write_rows(rows, sys.stdout, format)
+        else:
+            with open(options['output'], 'wb') as stream:
+                count = write_rows(rows, stream, format)
+        if int(options.get('verbosity', 1)) and options['output'] != '-':
+            self.stdout.write(u"Exported %d chunks\n" % count)
+
+
+def guess_format(path):
+    if path.lower().endswith('.csv'):
+        return 'csv'
+    return 'jsonl'
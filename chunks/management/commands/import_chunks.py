@@ -0,0 +1,46 @@
+import sys
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from chunks.bulk import read_rows, import_rows, InvalidRow
+from chunks.management.commands.export_chunks import guess_format
+
+
+class Command(BaseCommand):
+    args = '<file>'
+    help = "Create or update chunks and inline chunks from JSON Lines or " \
+           "CSV file made by export_chunks"
+
+    option_list = BaseCommand.option_list + (
+        make_option('--format', dest='format', default=None,
+            help='jsonl or csv, by extension of file by default'),
+        make_option('--batch-size', dest='batch_size', type='int',
+            default=500, help='Number of chunks saved at once'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("Provide file to import chunks from, "
+                               "- for stdin")
+        path = args[0]
+        format = options['format'] or guess_format(path)
+        if format not in ('jsonl', 'csv'):
+            raise CommandError("Unknown format %s" % format)
+
+        started = time.time()
+        try:
+            if path == '-':
+                created, updated = import_rows(read_rows(sys.stdin, format),
+                                               options['batch_size'])
+            else:
+                with open(path, 'rb') as stream:
+                    created, updated = import_rows(read_rows(stream, format),
+                                                   options['batch_size'])
+        except InvalidRow, e:
+            raise CommandError(unicode(e))
+        if int(options.get('verbosity', 1)):
+            self.stdout.write(u"Created %d and updated %d chunks in %.2f "
+                              u"seconds\n" % (created, updated,
+                                              time.time() - started))
@@ -0,0 +1,28 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+
+from chunks.models import Chunk, InlineChunk
+from chunks.search import search_index, create_index
+
+
+class Command(BaseCommand):
+    help = "Create search index of chunks used by admin and index all " \
+           "chunks again"
+
+    option_list = BaseCommand.option_list + (
+        make_option('--database', dest='database', default=DEFAULT_DB_ALIAS,
+            help='Database to build index in'),
+    )
+
+    def handle(self, *args, **options):
+        using = options['database']
+        if search_index(using) is None:
+            raise CommandError("Search index isn't supported by database "
+                               "%s or CHUNKS_SEARCH_INDEX is off" % using)
+        create_index([Chunk, InlineChunk], using, rebuild=True)
+        if int(options.get('verbosity', 1)):
+            self.stdout.write(u"Indexed %d chunks and %d inline chunks\n" % \
+                              (Chunk.objects.using(using).count(),
+                               InlineChunk.objects.using(using).count()))
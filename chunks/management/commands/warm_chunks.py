@@ -0,0 +1,207 @@
+import logging
+import time
+from itertools import groupby, islice
+from multiprocessing.pool import ThreadPool
+from optparse import make_option
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.db.models import Q
+
+from chunks.caching import chunks_cache, namespace_versions
+from chunks.models import Chunk, InlineChunk, cacheable_content, \
+                          object_chunks_namespaces, object_chunks_cache_key, \
+                          object_chunk_cache_key, chunks_cache_timeout, \
+                          chunk_record
+
+logger = logging.getLogger(__name__)
+
+
+def batches(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def close_connections():
+    # don't leave connections opened by builders in pool threads
+    for connection in connections.all():
+        connection.close()
+
+
+def render_plain(chunk):
+    """Return cache key and record of chunk as `render_chunk` does"""
+    try:
+        return Chunk.cache_key(chunk.key), chunk_record(chunk, None, {})
+    except Exception:
+        logger.exception(u"Failed to build chunk %s" % chunk.key)
+        return None
+    finally:
+        close_connections()
+
+
+def render_object(task):
+    """Return cache entries of `object_chunk` tag and of
+    `ChunksModel.chunks` for inline chunks of one object"""
+    obj, chunks, namespaces, versions, whole = task
+    items = {}
+    try:
+        for ch in chunks:
+            items[ch.key] = cacheable_content(ch, None, {}, obj=obj)
+    except Exception:
+        logger.exception(u"Failed to build chunks of %s" % obj)
+        return {}, None
+    finally:
+        close_connections()
+
+    entries = dict((object_chunk_cache_key(namespaces, key, versions=versions),
+                    content) for key, content in items.items())
+    chunks_entry = None
+    if whole:
+        chunks_entry = (object_chunks_cache_key(namespaces, versions=versions),
+                        items)
+    return entries, chunks_entry
+
+
+class Command(BaseCommand):
+    help = "Render chunks and inline chunks and put them into cache " \
+           "with the same keys as chunk tags use"
+
+    option_list = BaseCommand.option_list + (
+        make_option('--models', dest='models', default='',
+            help='Comma separated app_label.model of objects to warm '
+                 'inline chunks of, all by default'),
+        make_option('--prefix', dest='prefixes', default='',
+            help='Comma separated prefixes of chunk keys to warm'),
+        make_option('--skip-plain', action='store_true', dest='skip_plain',
+            default=False, help='Don\'t warm plain chunks'),
+        make_option('--skip-inline', action='store_true',
+            dest='skip_inline', default=False,
+            help='Don\'t warm inline chunks'),
+        make_option('--batch-size', dest='batch_size', type='int',
+            default=500, help='Number of chunks written to cache at once'),
+        make_option('--workers', dest='workers', type='int', default=4,
+            help='Number of threads rendering chunks'),
+        make_option('--cache-time', dest='cache_time', type='int',
+            default=getattr(settings, 'CHUNKS_CACHE_TIME', 300),
+            help='Cache time of chunk and object_chunk tags'),
+    )
+
+    def handle(self, *args, **options):
+        self.batch_size = options['batch_size']
+        self.cache_time = options['cache_time']
+        self.verbosity = int(options.get('verbosity', 1))
+        self.prefixes = [p for p in options['prefixes'].split(',') if p]
+        self.model_types = []
+        for label in [m for m in options['models'].split(',') if m]:
+            try:
+                app_label, model = label.lower().split('.')
+                self.model_types.append(ContentType.objects\
+                            .get_by_natural_key(app_label, model))
+            except (ValueError, ContentType.DoesNotExist):
+                raise CommandError("Unknown model %s" % label)
+
+        pool = ThreadPool(options['workers'])
+        try:
+            if not options['skip_plain']:
+                self.report(u'chunks', *self.warm_plain(pool))
+            if not options['skip_inline']:
+                self.report(u'inline chunks', *self.warm_inline(pool))
+        finally:
+            pool.close()
+            pool.join()
+
+    def report(self, name, count, seconds):
+        if self.verbosity:
+            self.stdout.write(u"Warmed %d %s in %.2f seconds "
+                              u"(%.1f chunks per second)\n" % (
+                              count, name, seconds,
+                              count / max(seconds, 0.001)))
+
+    def key_filter(self):
+        condition = Q()
+        for prefix in self.prefixes:
+            condition |= Q(key__startswith=prefix)
+        return condition
+
+    def warm_plain(self, pool):
+        started = time.time()
+        chunks = Chunk.objects.order_by('id').filter(self.key_filter())
+
+        count = 0
+        for batch in batches(chunks.iterator(), self.batch_size):
+            entries = dict(entry for entry in pool.map(render_plain, batch)
+                           if entry is not None)
+            chunks_cache.set_many(entries, self.cache_time)
+            count += len(batch)
+        return count, time.time() - started
+
+    def warm_inline(self, pool):
+        started = time.time()
+        chunks = InlineChunk.objects.filter(self.key_filter())\
+                    .order_by('content_type', 'object_id', 'order')
+        if self.model_types:
+            chunks = chunks.filter(content_type__in=self.model_types)
+
+        # chunks of one object are never split between batches
+        groups = groupby(chunks.iterator(), \
+                         lambda ch: (ch.content_type_id, ch.object_id))
+        count = 0
+        for batch in batches(groups, max(self.batch_size // 10, 1)):
+            batch = [(group, list(object_chunks)) \
+                     for group, object_chunks in batch]
+            count += sum(len(object_chunks) for group, object_chunks in batch)
+            self.warm_objects(pool, batch)
+        return count, time.time() - started
+
+    def warm_objects(self, pool, batch):
+        # load objects of each type at once
+        ids = {}
+        for (model_type_id, object_id), object_chunks in batch:
+            ids.setdefault(model_type_id, []).append(object_id)
+        objects = {}
+        for model_type_id, object_ids in ids.items():
+            model = ContentType.objects.get_for_id(model_type_id).model_class()
+            if model is None:
+                continue
+            for object_id, obj in model._default_manager\
+                                    .in_bulk(object_ids).items():
+                objects[(model_type_id, object_id)] = obj
+
+        tasks = []
+        all_namespaces = []
+        for group, object_chunks in batch:
+            obj = objects.get(group)
+            if obj is None:
+                continue
+            model_type = ContentType.objects.get_for_id(group[0])
+            namespaces = object_chunks_namespaces(model_type.app_label, \
+                                                  model_type.model, group[1])
+            all_namespaces.extend(namespaces)
+            tasks.append([obj, object_chunks, namespaces, None, \
+                          not self.prefixes])
+
+        # versions of all namespaces of the batch are fetched at once
+        versions = namespace_versions(all_namespaces)
+        for task in tasks:
+            size = len(task[2])
+            task[3], versions = versions[:size], versions[size:]
+
+        items = {}
+        whole = {}
+        for task, (entries, chunks_entry) in \
+                zip(tasks, pool.map(render_object, tasks)):
+            items.update(entries)
+            if chunks_entry is not None:
+                timeout = chunks_cache_timeout(task[0].__class__)
+                whole.setdefault(timeout, {})[chunks_entry[0]] = \
+                                                            chunks_entry[1]
+
+        chunks_cache.set_many(items, self.cache_time)
+        for timeout, entries in whole.items():
+            chunks_cache.set_many(entries, timeout)
@@ -1,7 +1,56 @@
+import logging
+
 from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse, HttpResponseNotModified
 from django.template.loader import render_to_string
-from chunks.models import Chunk
-from chunks.templatetags.chunks import CodeChunk
+from django.utils.cache import has_vary_header
+from chunks.caching import ABSENT, get_counters
+from chunks.models import cached_content
+from chunks.latebinding import late_binding_enabled, resolve_placeholders, \
+                               start_late_binding, stop_late_binding
+from chunks.templatetags.chunks import fetch_chunks
+from chunks.signals import chunks_rendered
+from chunks.tracking import start_tracking, stop_tracking, \
+                            start_stats, stop_stats, \
+                            start_dependencies, stop_dependencies
+from chunks.pagecache import page_headers_key, page_cache_key, \
+                             vary_headers, dependency_counters, \
+                             counter_versions, page_etag, \
+                             GLOBAL_COUNTERS, PAGE_CACHE_TIME
+
+logger = logging.getLogger(__name__)
+
+# `</body>` is looked for only in this number of last bytes of response
+SIDEBAR_TAIL_SIZE = 8192
+
+
+def inject_before_body_end(content, html):
+    """
+    Yield pieces of iterable `content` with `html` inserted before the
+    last `</body>`. Only last SIDEBAR_TAIL_SIZE bytes are held back to find
+    it, so streaming and iterator responses aren't buffered. Buffered
+    responses are still copied once when the sidebar is inserted.
+    """
+    pending = []
+    pending_size = 0
+    for piece in content:
+        if isinstance(piece, unicode):
+            piece = piece.encode('utf-8')
+        pending.append(piece)
+        pending_size += len(piece)
+        while pending_size - len(pending[0]) >= SIDEBAR_TAIL_SIZE:
+            pending_size -= len(pending[0])
+            yield pending.pop(0)
+
+    tail = ''.join(pending)
+    position = tail.rfind('</body>', max(len(tail) - SIDEBAR_TAIL_SIZE, 0))
+    if position < 0:
+        yield tail
+    else:
+        yield tail[:position]
+        yield html
+        yield tail[position:]
 
 
 class ChunksMiddleware(object):
@@ -10,17 +59,33 @@ class ChunksMiddleware(object):
     and prints them out in the end.
     """
     def process_request(self, request):
+        stop_late_binding()
+        if late_binding_enabled() and not request.is_ajax():
+            start_late_binding()
+        if getattr(settings, 'CHUNKS_INSTRUMENTATION', False):
+            start_stats()
         if getattr(settings, 'CHUNKS_WRAP', False):
             request.generated_chunks = []
+            start_tracking()
 
     def process_response(self, request, response):
+        stop_late_binding()
+        if late_binding_enabled():
+            # pages may come from cache with placeholders for any request
+            self.resolve_placeholders(request, response)
+
+        stats = stop_stats()
+        if stats is not None:
+            self.report_stats(request, response, stats)
+
         if not getattr(settings, 'CHUNKS_WRAP', False):
             return response
 
+        codechunks = stop_tracking()
         try:
             gchunks = []
             for chunk in request.generated_chunks:
-                if 'id' in chunk.keys():
+                if chunk.get('id'):
 #                    gchunks.append({'id': chunk.id,
 #                                'key': chunk.key,
 #                                'content': chunk.content,
@@ -38,26 +103,172 @@ class ChunksMiddleware(object):
 #                                    })
                     pass
 
-            # codechunks
-            for chunk in CodeChunk.codechunks:
-                # TODO caching!
-                ch = Chunk.objects.get(key=chunk.key)
-                if ch:
-                    gchunks.append({'id': ch.id,
-                                    'key': ch.key,
-                                    'content': ch.content,
-                                    'description': ch.description,
-                                    'wrapped': chunk.wrap,
-                                    'url': '/admin/chunks/chunk/',
+            # codechunks, all of them are fetched at once
+            cache_time = getattr(settings, 'CHUNKS_CACHE_TIME', 300)
+            context = {'request': request}
+            records = fetch_chunks(context, dict((key, cache_time) \
+                                           for key, wrap in codechunks))
+            for key, wrap in codechunks:
+                record = records.get(key)
+                if record is not None and record != ABSENT:
+                    content = cached_content(record['content'], \
+                                             request, context)
+                    gchunks.append({'id': record['id'],
+                                    'key': record['key'],
+                                    'content': content,
+                                    'original': content,
+                                    'description': record['description'],
+                                    'wrapped': wrap,
+                                    'url': '/admin/chunks/chunk',
                                     })
 
             table = render_to_string("chunks/chunks_sidebar.html", {'generated_chunks': gchunks})
-            response.content = response.content.replace('</body>', '%s</body>' % (table.encode('utf-8')))
-
-            CodeChunk.codechunks = []
+            self.inject_sidebar(response, table.encode('utf-8'))
         except AttributeError:
             pass
         except UnicodeDecodeError as e:
             print e
             print table
         return response
+
+    def resolve_placeholders(self, request, response):
+        """Replace placeholders of chunks in response with chunks, see
+        `chunks.latebinding`"""
+        if 'html' not in response.get('Content-Type', '') \
+                or getattr(response, 'streaming', False):
+            return
+        response.content = resolve_placeholders(response.content, request)
+        if response.has_header('Content-Length'):
+            response['Content-Length'] = str(len(response.content))
+
+    def report_stats(self, request, response, stats):
+        """Emit chunks stats of request as Server-Timing header, signal
+        and log record"""
+        timing = stats.server_timing()
+        if response.has_header('Server-Timing'):
+            timing = u'%s, %s' % (response['Server-Timing'], timing)
+        response['Server-Timing'] = timing
+        chunks_rendered.send(sender=self.__class__, request=request, \
+                             stats=stats)
+        logger.info(u"Chunks stats of %s" % request.path, \
+                    extra={'chunks_stats': stats.as_dict()})
+
+    def inject_sidebar(self, response, table):
+        """Insert sidebar `table` before `</body>`. Streamed content gets it
+        on the fly, buffered content is copied with it"""
+        if 'html' not in response.get('Content-Type', ''):
+            return
+
+        if getattr(response, 'streaming', False):
+            response.streaming_content = inject_before_body_end(\
+                                            response.streaming_content, table)
+        elif getattr(response, '_base_content_is_iter', False):
+            # iterator passed to HttpResponse is consumed lazily
+            response._container = inject_before_body_end(\
+                                            response._container, table)
+        else:
+            content = response.content
+            position = content.rfind('</body>', \
+                                     max(len(content) - SIDEBAR_TAIL_SIZE, 0))
+            if position < 0:
+                return
+            response.content = ''.join((content[:position], table, \
+                                        content[position:]))
+            if response.has_header('Content-Length'):
+                response['Content-Length'] = str(len(response.content))
+            return
+
+        if response.has_header('Content-Length'):
+            del response['Content-Length']
+
+
+class ChunksPageCacheMiddleware(object):
+    """
+    Caches whole pages requested with GET together with versions of chunks
+    and inline chunks used to render them. Cached page is served until any
+    of these chunks is changed, pages which don't use it stay cached.
+    Pages get ETag built from the versions, so unchanged pages are
+    answered with 304. Pages are cached separately for values of request
+    headers in Vary, responses with cookies or varying on cookie aren't
+    cached, nothing is cached while CHUNKS_WRAP is on.
+    """
+    def __init__(self, cache_timeout=None, key_prefix=''):
+        if cache_timeout is None:
+            cache_timeout = PAGE_CACHE_TIME
+        self.cache_timeout = cache_timeout
+        self.key_prefix = key_prefix
+
+    def process_request(self, request):
+        request._chunks_page = None
+        if request.method not in ('GET', 'HEAD') \
+                or getattr(settings, 'CHUNKS_WRAP', False):
+            return None
+
+        headers_key = page_headers_key(request, self.key_prefix)
+        values = cache.get_many([headers_key] + GLOBAL_COUNTERS)
+        if any(name not in values for name in GLOBAL_COUNTERS):
+            values.update(get_counters(GLOBAL_COUNTERS))
+
+        headers = values.get(headers_key)
+        if headers is not None:
+            entry = cache.get(page_cache_key(request, headers, \
+                                             self.key_prefix))
+            if entry is not None:
+                names, versions = entry[:2]
+                if counter_versions(names) == versions:
+                    return self.cached_response(request, entry)
+
+        request._chunks_page = (headers_key, \
+                                [values[name] for name in GLOBAL_COUNTERS], \
+                                start_dependencies())
+        return None
+
+    def process_response(self, request, response):
+        page = getattr(request, '_chunks_page', None)
+        if page is None:
+            return response
+        headers_key, started, dependencies = page
+        stop_dependencies(dependencies)
+        request._chunks_page = None
+
+        if request.method != 'GET' or response.status_code != 200 \
+                or getattr(response, 'streaming', False) \
+                or getattr(response, '_base_content_is_iter', False) \
+                or response.cookies or has_vary_header(response, 'Cookie'):
+            return response
+        headers = vary_headers(response)
+        if headers is None:
+            return response
+
+        names = dependency_counters(dependencies)
+        values = counter_versions(GLOBAL_COUNTERS + names)
+        if values[:len(GLOBAL_COUNTERS)] != started:
+            # some chunk was changed during render, page may be outdated
+            return response
+        versions = values[len(GLOBAL_COUNTERS):]
+
+        etag = page_etag(versions, response.content)
+        response['ETag'] = etag
+        page_key = page_cache_key(request, headers, self.key_prefix)
+        cache.set_many({headers_key: headers,
+                        page_key: (names, versions, etag, \
+                                   response.status_code, response.items(), \
+                                   response.content)}, \
+                       self.cache_timeout)
+        if request.META.get('HTTP_IF_NONE_MATCH') == etag:
+            return self.not_modified(etag)
+        return response
+
+    def cached_response(self, request, entry):
+        names, versions, etag, status, headers, content = entry
+        if request.META.get('HTTP_IF_NONE_MATCH') == etag:
+            return self.not_modified(etag)
+        response = HttpResponse(content, status=status)
+        for header, value in headers:
+            response[header] = value
+        return response
+
+    def not_modified(self, etag):
+        response = HttpResponseNotModified()
+        response['ETag'] = etag
+        return response
@@ -1,24 +1,42 @@
 import logging
+import threading
+import time
+from multiprocessing.pool import ThreadPool
 
 from django.utils.importlib import import_module
 from django.conf import settings
-from django.db import models
+from django.db import models, transaction, connections, IntegrityError, \
+                      close_connection
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes import generic
-from django.core.cache import cache
-from django.db.models.signals import post_save, pre_delete
+from django.core.signals import request_finished
+from django.db.models.signals import post_save, pre_delete, post_syncdb
 from django.utils.translation import ugettext_lazy as _
 
-from builders import ChunkBuilder
-from listeners import clear_plain_chunk_cache
+from builders import builders_registry, model_label
+from caching import chunks_cache, safe_key, versioned_key, bump_namespace, \
+                    bump_generation, namespace_versions, \
+                    ABSENT, ABSENT_CACHE_TIME, IMPORTS_NAMESPACE
+from tracking import track_codechunk, current_stats, resume_stats, \
+                     stop_stats, track_object_dependency
+from listeners import clear_plain_chunk_cache, clear_inline_chunk_cache, \
+                      refresh_plain_chunk_cache, refresh_inline_chunk_cache, \
+                      bump_chunks_generation, invalidate_chunk_pages, \
+                      create_search_index, \
+                      index_chunk, unindex_chunk
+from search import update_index
 
 logger = logging.getLogger(__name__)
 
 CACHE_PREFIX = 'chunks_obj'
+DYNAMIC_MARKER = 'chunks:dynamic'
+# cache time of chunks put into cache on save, see CHUNKS_WRITE_THROUGH
+WRITE_THROUGH_TIME = getattr(settings, 'CHUNKS_CACHE_TIME', 300)
 
-# force init of chunks builders
+# chunks builders, they are imported on first use
 CHUNK_BUILDERS_LIST = getattr(settings, 'CHUNK_BUILDERS', [])
-CHUNK_BUILDERS = []
+CHUNK_BUILDERS = builders_registry
+CHUNK_BUILDERS_INDEX = builders_registry
 
 
 class Chunk(models.Model):
@@ -29,6 +47,8 @@ class Chunk(models.Model):
     tag
     """
     ITEM_CACHE_PREFIX = "chunk_"
+    # fields indexed for admin search, see chunks.search
+    search_fields = ('key', 'description', 'content')
 
     key = models.CharField(_(u"Key"), \
             help_text=_(u"A unique name for this chunk of content"), \
@@ -36,16 +56,45 @@ class Chunk(models.Model):
     content = models.TextField(_(u"Content"), blank=True)
     description = models.CharField(_(u"Description"), max_length=255)
 
+    @staticmethod
+    def cache_key(key):
+        """Cache key of rendered chunk"""
+        return safe_key(Chunk.ITEM_CACHE_PREFIX, key)
+
+    @staticmethod
+    def normalize_key(key):
+        """Replace spaces with _ and make the key lowercase - caching
+        precautions"""
+        return key.replace(' ', '_').lower()
+
     def clear_cache(self):
         logger.debug(u"Clean up chunk %s" % self.key)
-        cache.delete(Chunk.ITEM_CACHE_PREFIX + self.key)
+        chunks_cache.delete(Chunk.cache_key(self.key))
+
+    def refresh_cache(self):
+        """Put rendered chunk into cache instead of deleting it, so the
+        next requests don't rebuild it at once"""
+        logger.debug(u"Refresh chunk %s" % self.key)
+        try:
+            record = chunk_record(self, None, {})
+        except Exception:
+            logger.exception(u"Failed to build chunk %s" % self.key)
+            self.clear_cache()
+            return
+        chunks_cache.set(Chunk.cache_key(self.key), record, WRITE_THROUGH_TIME)
+
+    def builder(self, obj=None):
+        """Return builder of the chunk, it's resolved once per instance"""
+        if '_builder' not in self.__dict__:
+            self._builder = CHUNK_BUILDERS_INDEX.resolve(self.key, chunk=self)
+        return self._builder
 
     def build_content(self, request, context):
         """Build content with builder or with default builder"""
-        for builder in CHUNK_BUILDERS:
-            if builder.appropriate_key(self.key, chunk=self):
-                return builder.render(request, self, \
-                            parent=None, context=context)
+        builder = self.builder()
+        if builder is not None:
+            return builder.cached_render(request, self, \
+                        parent=None, context=context)
         return self.content
 
     def __unicode__(self):
@@ -53,8 +102,9 @@ class Chunk(models.Model):
 
     def save(self, force_insert=False, force_update=False, using=None):
 
-        # replace spaces with _ and make the key lowercase - caching precautions
-        self.key = self.key.replace(' ', '_').lower()
+        self.key = Chunk.normalize_key(self.key)
+        # content may be changed since builder was resolved
+        self.__dict__.pop('_builder', None)
 
         super(Chunk, self).save(force_insert, force_update, using)
 
@@ -64,6 +114,8 @@ class Chunk(models.Model):
 
 
 class InlineChunk(models.Model):
+    search_fields = ('key', 'desc', 'content')
+
     desc = models.CharField(_(u"Description"), max_length=255)
     key = models.CharField(_(u"Key"), \
                             help_text=_("A name for this chunk of content"), \
@@ -84,16 +136,70 @@ class InlineChunk(models.Model):
     def __unicode__(self):
         return u"%s / %s" % (self.content_object, self.key)
 
+    def clear_cache(self):
+        logger.debug(u"Clean up inline chunk %s" % self.key)
+        model_type = ContentType.objects.get_for_id(self.content_type_id)
+        bump_namespace(object_chunks_namespaces(model_type.app_label, \
+                                model_type.model, self.object_id)[-1])
+
+    def refresh_cache(self):
+        """Invalidate chunks cache of object and put rendered chunks of
+        the object into it, so the next requests don't rebuild them"""
+        self.clear_cache()
+        obj = self.content_object
+        if obj is None:
+            return
+        model_type = ContentType.objects.get_for_id(self.content_type_id)
+        namespaces = object_chunks_namespaces(model_type.app_label, \
+                                              model_type.model, self.object_id)
+        versions = namespace_versions(namespaces)
+        chunks = InlineChunk.objects.filter(content_type=model_type, \
+                                            object_id=self.object_id)
+        try:
+            chunks_content, failed = build_chunks(chunks, None, {}, obj=obj)
+        except Exception:
+            # e.g. builder needs request, chunks are built on next request
+            logger.exception(u"Failed to build chunks of %s" % obj)
+            return
+
+        # fallback content of failed builders isn't cached
+        entries = dict((object_chunk_cache_key(namespaces, key, \
+                                               versions=versions), content) \
+                       for key, content in chunks_content.items() \
+                       if key not in failed)
+        chunks_cache.set_many(entries, WRITE_THROUGH_TIME)
+        if not failed and isinstance(obj, ChunksModel):
+            chunks_cache.set(object_chunks_cache_key(namespaces, \
+                                                     versions=versions), \
+                             chunks_content, \
+                             chunks_cache_timeout(obj.__class__))
+
+    def builder(self, obj=None):
+        """Return builder of the chunk for `obj`, it's resolved once per
+        instance and object"""
+        if not obj:
+            obj = self.content_object
+        cached = self.__dict__.get('_builder')
+        if cached is None or cached[0] is not obj:
+            cached = self._builder = (obj, CHUNK_BUILDERS_INDEX.resolve(\
+                                        self.key, chunk=self, obj=obj))
+        return cached[1]
+
+    def save(self, *args, **kwargs):
+        # content may be changed since builder was resolved
+        self.__dict__.pop('_builder', None)
+        super(InlineChunk, self).save(*args, **kwargs)
+
     def build_content(self, request, context, obj=None):
         """Build content with builder or with default builder"""
 
         if not obj:
             obj = self.content_object
 
-        for builder in CHUNK_BUILDERS:
-            if builder.appropriate_key(self.key, chunk=self, obj=obj):
-                return builder.render(request, self, \
-                            parent=obj, context=context)
+        builder = self.builder(obj)
+        if builder is not None:
+            return builder.cached_render(request, self, \
+                        parent=obj, context=context)
         return self.content
 
 
@@ -108,91 +214,430 @@ class ChunksModel(object):
         post_save.connect(clear_chunks_cache, sender=YourCustomModel)
         pre_delete.connect(clear_chunks_cache, sender=YourCustomModel)
     """
+    @property
+    def chunks_namespaces(self):
+        return object_chunks_namespaces(self._meta.app_label, \
+                                        self._meta.object_name.lower(), \
+                                        self.id)
+
     @property
     def chunks_cache_key(self):
-        return "%s_%s_%d" % (
-            CACHE_PREFIX,
-            self._meta.object_name.lower(),
-            self.id)
+        return object_chunks_cache_key(self.chunks_namespaces)
 
     def chunk_item_cache_key(self, key):
-        return "%s_%s_%d_%s" % (
-                    Chunk.ITEM_CACHE_PREFIX,
-                    self._meta.object_name.lower(),
-                    self.id,
-                    key)
+        return object_chunk_cache_key(self.chunks_namespaces, key)
 
     def clear_chunks_cache(self):
         """Cleanup ChunksModel.chunks cache and cache
         for appropriate template tag"""
         logger.debug(\
             u"Clean up cache for list of chunks for %s" % unicode(self))
-        cache.delete(self.chunks_cache_key)
+        # all cache keys of the object are changed at once
+        bump_namespace(self.chunks_namespaces[-1])
 
-        model_type = ContentType.objects.get_for_model(self.__class__)
-        object_id = self.id
+        # forget chunks loaded by `prefetch_chunks`
+        self.__dict__.pop('_prefetched_chunks', None)
 
-        chunks = InlineChunk.objects.filter(content_type=model_type, \
-                                                object_id=object_id)
-        # cleanup all cache for all available chunks of current object
-        for ch in chunks:
-            cache.delete(self.chunk_item_cache_key(ch.key))
+    @classmethod
+    def clear_model_chunks_cache(cls):
+        """Cleanup chunks cache of all objects of the model"""
+        logger.debug(\
+            u"Clean up cache for chunks of all %s objects" % cls.__name__)
+        bump_namespace(object_chunks_namespaces(cls._meta.app_label, \
+                                        cls._meta.object_name.lower())[-2])
 
     def chunks(self, request, context):
         """Return list of available chunks for current object
         as python dictionary
         """
+        track_object_dependency(self._meta.app_label, \
+                                self._meta.object_name.lower(), self.id)
+        prefetched = getattr(self, '_prefetched_chunks', None)
+        if prefetched is not None:
+            # chunks are loaded by `prefetch_chunks`
+            chunks_content, failed = build_chunks(prefetched.values(), \
+                                                request, context, obj=self)
+            return dict((key, cached_content(value, request, context, \
+                                             obj=self)) \
+                        for key, value in chunks_content.items())
+
         model_type = ContentType.objects.get_for_model(self.__class__)
         object_id = self.id
 
         cache_key = self.chunks_cache_key
 
         # read cache timeout, if==0 then chage will be disabled
-        cache_timeout = 0
-        if hasattr(self, 'ChunksMeta') \
-            and hasattr(self.ChunksMeta, 'chunks_cache_timeout'):
-            cache_timeout = getattr(self.ChunksMeta, \
-                                    'chunks_cache_timeout', 0)
-            if not cache_timeout:
-                cache_timeout = 0
-
-        chunks_content = cache.get(cache_key)
+        cache_timeout = chunks_cache_timeout(self.__class__)
+
+        chunks_content = chunks_cache.get(cache_key)
 #        chunks_content = {} # why was this here? Doesn't make sense.
-        if not chunks_content:
-            chunks = InlineChunk.objects.filter(content_type=model_type, \
-                                                    object_id=object_id)
+        stats = current_stats()
+        if stats is not None:
+            if chunks_content is None:
+                stats.miss('ChunksModel.chunks')
+                stats.lookup('ChunksModel.chunks')
+            else:
+                stats.hit('ChunksModel.chunks')
+        if chunks_content == ABSENT:
+            return {}
+        if chunks_content is None:
+            chunks = chunk_storage().inline_chunks(\
+                            [(model_type.id, object_id)]).get(\
+                            (model_type.id, object_id), [])
             # build all chunks for this particular object
-            for ch in chunks:
-                chunks_content[ch.key] = ch.build_content(\
-                                            request, context, obj=self)
-            cache.set(cache_key, chunks_content, cache_timeout)
+            chunks_content, failed = build_chunks(chunks, \
+                                                request, context, obj=self)
+            if not chunks_content:
+                chunks_cache.set(cache_key, ABSENT, ABSENT_CACHE_TIME)
+            elif not failed:
+                # don't cache fallback content of failed builders
+                chunks_cache.set(cache_key, chunks_content, cache_timeout)
 
-        return chunks_content
+        return dict((key, cached_content(value, request, context, obj=self)) \
+                    for key, value in chunks_content.items())
+
+
+def cacheable_content(chunk, request, context, obj=None):
+    """
+    Return content of chunk to put into cache. Output of builder with
+    `cache_vary_on` is different for each request, so raw chunk is cached
+    instead with ident of its builder and it's built by `cached_content`
+    on each render.
+    """
+    builder = chunk.builder(obj)
+    if builder is not None and builder.cache_vary_on:
+        return (DYNAMIC_MARKER, model_label(chunk.__class__), chunk.pk, \
+                chunk.key, chunk.content, builder.ident)
+    if isinstance(chunk, InlineChunk):
+        return chunk.build_content(request, context, obj=obj)
+    return chunk.build_content(request, context)
+
+
+BUILDER_THREADS = getattr(settings, 'CHUNKS_BUILDER_THREADS', 0)
+BUILDER_TIMEOUT = getattr(settings, 'CHUNKS_BUILDER_TIMEOUT', 5)
+
+_builders_pool = None
+_builders_pool_lock = threading.Lock()
+# chunks queued or being built in the pool, builders which timed out
+# still occupy their threads until they finish
+_pool_tasks = 0
+
+
+def builders_pool():
+    """Return shared pool of threads for builders or None if concurrent
+    rendering is disabled"""
+    global _builders_pool
+    if not BUILDER_THREADS:
+        return None
+    if _builders_pool is None:
+        with _builders_pool_lock:
+            if _builders_pool is None:
+                _builders_pool = ThreadPool(BUILDER_THREADS)
+    return _builders_pool
+
+
+def _reserve_pool_thread():
+    """Count task to be queued to the pool unless all its threads are
+    busy"""
+    global _pool_tasks
+    with _builders_pool_lock:
+        if _pool_tasks >= BUILDER_THREADS:
+            return False
+        _pool_tasks += 1
+        return True
+
+
+def _build_in_thread(chunk, request, context, obj, stats):
+    global _pool_tasks
+    # builder time counts in stats of the request
+    resume_stats(stats)
+    try:
+        return cacheable_content(chunk, request, context, obj=obj)
+    finally:
+        stop_stats()
+        with _builders_pool_lock:
+            _pool_tasks -= 1
+        # don't leave connections opened by builder in pool threads
+        for connection in connections.all():
+            connection.close()
+
+
+def build_chunks(chunks, request, context, obj=None):
+    """
+    Return dictionary with cacheable content of `chunks` and set of keys
+    of chunks which weren't built. If CHUNKS_BUILDER_THREADS is set, chunks of
+    builders marked as `thread_safe` are built concurrently. Content of
+    chunk which builder raised or didn't finish in its `render_timeout`
+    is replaced with raw chunk content. Builder which timed out keeps
+    its pool thread until it finishes, so chunks are built in calling
+    thread while all pool threads are busy instead of waiting in queue.
+    """
+    chunks_content = {}
+    failed = set()
+    pending = []
+    pool = builders_pool()
+    stats = current_stats()
+    for ch in chunks:
+        builder = None
+        if pool is not None:
+            builder = ch.builder(obj)
+        if builder is not None and builder.thread_safe \
+                and _reserve_pool_thread():
+            timeout = builder.render_timeout or BUILDER_TIMEOUT
+            result = pool.apply_async(_build_in_thread, \
+                                      (ch, request, context, obj, stats))
+            pending.append((ch, time.time() + timeout, result))
+        else:
+            chunks_content[ch.key] = cacheable_content(\
+                                        ch, request, context, obj=obj)
+
+    for ch, deadline, result in pending:
+        try:
+            chunks_content[ch.key] = result.get(\
+                                        max(deadline - time.time(), 0))
+        except Exception:
+            logger.exception(u"Failed to build chunk %s" % ch.key)
+            chunks_content[ch.key] = ch.content
+            failed.add(ch.key)
+    return chunks_content, failed
+
+
+def chunk_record(c, request, context):
+    """Cacheable representation of rendered chunk"""
+    return {'id': c.id,
+            'key': c.key,
+            'content': cacheable_content(c, request, context),
+            'description': c.description,
+           }
+
+
+def absent_record(key):
+    """Record of chunk which doesn't exist yet, it's displayed as its key"""
+    return {'id': None,
+            'key': key,
+            'content': key,
+            'description': '',
+           }
+
+
+def cached_content(value, request, context, obj=None):
+    """Return content from value built by `cacheable_content`. Builder
+    is found by its ident, so content isn't searched for markers again.
+    Values without ident cached by previous versions are accepted too"""
+    if not (isinstance(value, tuple) and len(value) in (5, 6) \
+                and value[0] == DYNAMIC_MARKER):
+        return value
+    label, pk, key, content = value[1:5]
+    builder = None
+    if len(value) == 6:
+        builder = CHUNK_BUILDERS_INDEX.builder_by_ident(value[5])
+    if label == model_label(InlineChunk):
+        chunk = InlineChunk(id=pk, key=key, content=content)
+        if builder is not None:
+            chunk._builder = (obj or chunk.content_object, builder)
+        return chunk.build_content(request, context, obj=obj)
+    chunk = Chunk(id=pk, key=key, content=content)
+    if builder is not None:
+        chunk._builder = builder
+    return chunk.build_content(request, context)
+
+
+def object_chunks_namespaces(app_label, model_name, object_id=None):
+    """Return cache namespaces of imports, whole model and particular
+    object, bumping any of them invalidates chunks cache of the object"""
+    model_namespace = u'%s.%s' % (app_label, model_name)
+    return (IMPORTS_NAMESPACE, model_namespace, \
+            u'%s.%s' % (model_namespace, object_id))
+
+
+def object_chunks_cache_key(namespaces, versions=None):
+    """Cache key of `ChunksModel.chunks` for object with `namespaces`"""
+    return versioned_key(CACHE_PREFIX + '_', namespaces, versions=versions)
+
+
+def object_chunk_cache_key(namespaces, key, versions=None):
+    """Cache key of `object_chunk` tag for object with `namespaces`"""
+    return versioned_key(Chunk.ITEM_CACHE_PREFIX + 'item_', namespaces, \
+                         key, versions=versions)
+
+
+def chunks_cache_timeout(model):
+    """Return cache timeout of `ChunksModel.chunks` of model"""
+    cache_timeout = 0
+    if hasattr(model, 'ChunksMeta') \
+        and hasattr(model.ChunksMeta, 'chunks_cache_timeout'):
+        cache_timeout = getattr(model.ChunksMeta, \
+                                'chunks_cache_timeout', 0)
+        if not cache_timeout:
+            cache_timeout = 0
+    return cache_timeout
+
+
+_chunk_storage = None
+
+
+def chunk_storage():
+    """Return storage chunks are read from, see `chunks.storage`"""
+    global _chunk_storage
+    if _chunk_storage is None:
+        path = getattr(settings, 'CHUNKS_STORAGE', \
+                       'chunks.storage.ORMStorage')
+        module_name, cls_name = path.rsplit('.', 1)
+        _chunk_storage = getattr(import_module(module_name), cls_name)()
+    return _chunk_storage
+
+
+def prefetch_chunks(objects):
+    """
+    Load inline chunks of all `objects` (instances of `ChunksModel`
+    subclasses) with one query (see `chunk_storage`) and attach them to
+    the objects, so `object_chunk`, `object_chunks_list` and
+    `ChunksModel.chunks` don't touch database or cache for them. Usage:
+        products = prefetch_chunks(Product.objects.all()[:50])
+    """
+    objects = list(objects)
+    by_type = {}
+    for obj in objects:
+        model_type = ContentType.objects.get_for_model(obj.__class__)
+        by_type.setdefault(model_type.id, {})[obj.id] = obj
+        obj._prefetched_chunks = {}
+
+    if not by_type:
+        return objects
+
+    pairs = [(model_type_id, object_id) \
+             for model_type_id, objs in by_type.items() for object_id in objs]
+    for (model_type_id, object_id), object_chunks in \
+            chunk_storage().inline_chunks(pairs).items():
+        obj = by_type[model_type_id].get(object_id)
+        if obj is not None:
+            for ch in object_chunks:
+                obj._prefetched_chunks[ch.key] = ch
+    return objects
+
+
+# keys of missing chunks to create, see `queue_chunk`
+_pending_chunks = set()
+_pending_chunks_lock = threading.Lock()
+_pending_chunks_timer = None
+
+CHUNKS_CREATE_DELAY = getattr(settings, 'CHUNKS_CREATE_DELAY', None)
+
+
+def queue_chunk(key):
+    """Schedule creation of missing chunk. Chunks are created in bulk at the
+    end of request or in CHUNKS_CREATE_DELAY seconds if it's set"""
+    global _pending_chunks_timer
+    with _pending_chunks_lock:
+        _pending_chunks.add(key)
+        if CHUNKS_CREATE_DELAY and _pending_chunks_timer is None:
+            _pending_chunks_timer = threading.Timer(CHUNKS_CREATE_DELAY, \
+                                                    _flush_in_thread)
+            _pending_chunks_timer.daemon = True
+            _pending_chunks_timer.start()
+
+
+def _flush_in_thread():
+    try:
+        flush_pending_chunks()
+    finally:
+        # timer thread is never used again
+        for connection in connections.all():
+            connection.close()
+
+
+def flush_pending_chunks(*args, **kwargs):
+    """Create all chunks scheduled by `queue_chunk` with one query.
+    Connected to `request_finished` signal before connections are closed"""
+    global _pending_chunks_timer
+    with _pending_chunks_lock:
+        keys = list(_pending_chunks)
+        _pending_chunks.clear()
+        _pending_chunks_timer = None
+    if not keys:
+        return
+
+    # chunk is displayed as its key until it's changed
+    new_chunks = {}
+    for key in keys:
+        new_chunks.setdefault(Chunk.normalize_key(key), key)
+    existing = Chunk.objects.filter(key__in=new_chunks.keys())\
+                            .values_list('key', flat=True)
+    for key in existing:
+        del new_chunks[key]
+    if not new_chunks:
+        return
+
+    logger.debug(u"Create chunks %s" % u", ".join(new_chunks))
+    try:
+        Chunk.objects.bulk_create([Chunk(key=key, content=content, \
+                                         description='')
+                                   for key, content in new_chunks.items()])
+    except IntegrityError:
+        # some of them are created by other process meanwhile
+        transaction.rollback_unless_managed()
+        for key, content in new_chunks.items():
+            Chunk.objects.get_or_create(key=key, \
+                        defaults={'content': content, 'description': ''})
+
+    # signals aren't sent by bulk_create
+    update_index(Chunk, Chunk.objects.filter(key__in=new_chunks.keys()))
+    for key in keys:
+        chunks_cache.delete(Chunk.cache_key(key))
+    bump_generation()
 
 
 def codechunk(key, wrap=False):
     """
     Returns the given chunk. Use this function to place chunks in code (views, widgets, etc.)
     """
-    from chunks.templatetags.chunks import render_chunk, CodeChunk
+    from chunks.templatetags.chunks import render_chunk
 
-    CodeChunk(key, wrap)
+    track_codechunk(key, wrap)
     return render_chunk({}, key, wrap)
 
-# import and cache all available chunks builders
-for cb in CHUNK_BUILDERS_LIST:
-    package = cb[:cb.index('.')]
-    cls_name = cb[cb.rindex('.') + 1:]
-    module_name = cb[len(package) + 1:-len(cls_name) - 1]
 
-    mdl = import_module(module_name, package=package)
-    cls = getattr(mdl, cls_name)
-    CHUNK_BUILDERS.append(cls())
+def codechunks(keys, wrap=False):
+    """
+    Returns dictionary with the given chunks. They are fetched at once: one
+    cache round trip for all of them and one query for cache misses, so use
+    it instead of several `codechunk` calls.
+    """
+    from chunks.templatetags.chunks import fetch_chunks, render_chunk
 
-# add default builder to end of list of builders
-CHUNK_BUILDERS.append(ChunkBuilder())
+    cache_time = getattr(settings, 'CHUNKS_CACHE_TIME', 300)
+    records = fetch_chunks({}, dict((key, cache_time) for key in keys))
+    result = {}
+    for key in keys:
+        track_codechunk(key, wrap)
+        result[key] = render_chunk({}, key, wrap, cache_time, \
+                                   record=records.get(key))
+    return result
 
 
 # cleanup Chunk model cache
-post_save.connect(clear_plain_chunk_cache, sender=Chunk)
+post_save.connect(refresh_plain_chunk_cache, sender=Chunk)
 pre_delete.connect(clear_plain_chunk_cache, sender=Chunk)
+post_save.connect(refresh_inline_chunk_cache, sender=InlineChunk)
+pre_delete.connect(clear_inline_chunk_cache, sender=InlineChunk)
+post_save.connect(bump_chunks_generation, sender=Chunk)
+pre_delete.connect(bump_chunks_generation, sender=Chunk)
+# flush before Django closes connections at the end of request, so they
+# aren't opened again and left open
+request_finished.disconnect(close_connection)
+request_finished.connect(flush_pending_chunks)
+request_finished.connect(close_connection)
+
+# cleanup builders cache on saves of their cache_invalidate_on models
+builders_registry.connect()
+
+# invalidate pages cached with ChunksPageCacheMiddleware
+post_save.connect(invalidate_chunk_pages, sender=Chunk)
+pre_delete.connect(invalidate_chunk_pages, sender=Chunk)
+
+# keep admin search index in sync
+post_save.connect(index_chunk, sender=Chunk)
+post_save.connect(index_chunk, sender=InlineChunk)
+pre_delete.connect(unindex_chunk, sender=Chunk)
+pre_delete.connect(unindex_chunk, sender=InlineChunk)
+post_syncdb.connect(create_search_index)
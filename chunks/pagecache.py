@@ -0,0 +1,80 @@
+"""Helpers of full page cache which is invalidated when any chunk used by
+the page is changed, see `chunks.middleware.ChunksPageCacheMiddleware`"""
+import hashlib
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.cache import cc_delim_re
+
+from chunks.caching import get_counters, hashed_key, chunk_version_key, \
+                           GENERATION_KEY, OBJECTS_GENERATION_KEY, \
+                           NAMESPACE_PREFIX, BUILDERS_NAMESPACE, \
+                           IMPORTS_NAMESPACE
+from chunks.models import object_chunks_namespaces
+
+PAGE_CACHE_PREFIX = 'chunks_page_'
+PAGE_HEADERS_PREFIX = 'chunks_page_headers_'
+PAGE_CACHE_TIME = getattr(settings, 'CHUNKS_PAGE_CACHE_TIME', 600)
+# output of builders isn't tracked per page, so all pages depend on it
+BUILDERS_COUNTER = NAMESPACE_PREFIX + BUILDERS_NAMESPACE
+# imports invalidate all pages at once, see `chunks.bulk.invalidate`
+IMPORTS_COUNTER = NAMESPACE_PREFIX + IMPORTS_NAMESPACE
+# counters changed by any chunk edit, they are read when page render is
+# started to find out whether anything was changed during the render
+GLOBAL_COUNTERS = [GENERATION_KEY, OBJECTS_GENERATION_KEY, BUILDERS_COUNTER,
+                   IMPORTS_COUNTER]
+
+
+def page_headers_key(request, key_prefix=''):
+    """Cache key of request headers which page requested by GET or HEAD
+    `request` varies on, as in `django.utils.cache.learn_cache_key`"""
+    return hashed_key(PAGE_HEADERS_PREFIX, key_prefix, \
+                      request.build_absolute_uri())
+
+
+def page_cache_key(request, headers, key_prefix=''):
+    """Cache key of page requested by GET or HEAD `request` for values of
+    request `headers` it varies on"""
+    return hashed_key(PAGE_CACHE_PREFIX, key_prefix, \
+                      request.build_absolute_uri(), \
+                      *[request.META.get(header, '') for header in headers])
+
+
+def vary_headers(response):
+    """Return META names of request headers `response` varies on or None
+    if it varies on anything"""
+    if not response.has_header('Vary'):
+        return []
+    headers = []
+    for header in cc_delim_re.split(response['Vary']):
+        if header == '*':
+            return None
+        headers.append('HTTP_' + header.upper().replace('-', '_'))
+    return headers
+
+
+def dependency_counters(dependencies):
+    """Return sorted names of counters which are changed when any chunk
+    recorded in `dependencies` is changed"""
+    names = set(chunk_version_key(key) for key in dependencies.keys)
+    names.add(BUILDERS_COUNTER)
+    names.add(IMPORTS_COUNTER)
+    for app_label, model_name, object_id in dependencies.objects:
+        names.update(NAMESPACE_PREFIX + namespace for namespace in \
+                object_chunks_namespaces(app_label, model_name, object_id))
+    if dependencies.all_chunks:
+        names.add(GENERATION_KEY)
+    return sorted(names)
+
+
+def counter_versions(names):
+    """Current values of counters. Counters are incremented in Django
+    cache directly, so they are read from it and not from local cache"""
+    counters = get_counters(names, backend=cache)
+    return [counters[name] for name in names]
+
+
+def page_etag(versions, content):
+    """ETag of page with `content` built from chunks of `versions`"""
+    digest = hashlib.md5(content).hexdigest()
+    return '"%s"' % hashed_key('', digest, *versions)
@@ -0,0 +1,233 @@
+"""
+Indexed full-text search of chunks used by admin. Fields listed in
+`search_fields` of `Chunk` and `InlineChunk` are indexed in separate
+tables, `<table of model>_search`:
+
+ * SQLite: FTS4 virtual table
+ * PostgreSQL: table of tsvector documents with GIN index
+
+Index tables are created by syncdb or `rebuild_chunks_search` command and
+kept in sync by save and delete signals and `import_chunks`. Other
+databases, databases which can't create index tables (e.g. SQLite without
+FTS4) or without them are searched with `icontains` lookups as usual.
+Processes notice tables created by others after restart.
+"""
+import logging
+import re
+
+from django.conf import settings
+from django.db import connections, transaction, DatabaseError, \
+                      DEFAULT_DB_ALIAS
+
+logger = logging.getLogger(__name__)
+
+WORD_RE = re.compile(r'[^\W_]+', re.U)
+
+# whether index tables exist by (alias, table)
+_existing = {}
+# aliases of databases which failed to create index tables
+_unsupported = set()
+
+
+class SearchIndex(object):
+    """Base of database specific index tables"""
+    def __init__(self, connection):
+        self.connection = connection
+
+    def quote(self, name):
+        return self.connection.ops.quote_name(name)
+
+    def create(self, cursor, model):
+        raise NotImplementedError
+
+    def fill(self, cursor, model):
+        """Index all rows of `model` table"""
+        raise NotImplementedError
+
+    def insert(self, cursor, model, rows):
+        """Index `rows`, lists of primary key and values of fields"""
+        raise NotImplementedError
+
+    def delete(self, cursor, model, ids):
+        raise NotImplementedError
+
+    def condition(self, model, words):
+        """Return SQL condition and its parameters matching rows of `model`
+        which contain all `words`"""
+        raise NotImplementedError
+
+    def clear(self, cursor, model):
+        cursor.execute('DELETE FROM %s' % self.quote(index_table(model)))
+
+
+class SQLiteIndex(SearchIndex):
+    def create(self, cursor, model):
+        cursor.execute('CREATE VIRTUAL TABLE %s USING fts4(%s, '
+                       'tokenize=unicode61)' % \
+                       (self.quote(index_table(model)), \
+                        ', '.join(model.search_fields)))
+
+    def fill(self, cursor, model):
+        fields = ', '.join(self.quote(model._meta.get_field(name).column) \
+                           for name in model.search_fields)
+        cursor.execute('INSERT INTO %s (docid, %s) SELECT %s, %s FROM %s' % \
+                       (self.quote(index_table(model)), \
+                        ', '.join(model.search_fields), \
+                        self.quote(model._meta.pk.column), fields, \
+                        self.quote(model._meta.db_table)))
+
+    def insert(self, cursor, model, rows):
+        cursor.executemany('INSERT INTO %s (docid, %s) VALUES (%s)' % \
+                           (self.quote(index_table(model)), \
+                            ', '.join(model.search_fields), \
+                            ', '.join(['%s'] * \
+                                      (len(model.search_fields) + 1))), \
+                           rows)
+
+    def delete(self, cursor, model, ids):
+        cursor.execute('DELETE FROM %s WHERE docid IN (%s)' % \
+                       (self.quote(index_table(model)), \
+                        ', '.join(['%s'] * len(ids))), ids)
+
+    def condition(self, model, words):
+        table = self.quote(index_table(model))
+        return '%s.%s IN (SELECT docid FROM %s WHERE %s MATCH %%s)' % \
+               (self.quote(model._meta.db_table), \
+                self.quote(model._meta.pk.column), table, table), \
+               [u' '.join(u'%s*' % word for word in words)]
+
+
+class PostgreSQLIndex(SearchIndex):
+    def create(self, cursor, model):
+        table = index_table(model)
+        cursor.execute('CREATE TABLE %s (id integer PRIMARY KEY, '
+                       'document tsvector NOT NULL)' % self.quote(table))
+        cursor.execute('CREATE INDEX %s ON %s USING gin(document)' % \
+                       (self.quote(table + '_document'), self.quote(table)))
+
+    def fill(self, cursor, model):
+        columns = [self.quote(model._meta.get_field(name).column) \
+                   for name in model.search_fields]
+        cursor.execute('INSERT INTO %s (id, document) SELECT %s, '
+                       "to_tsvector('simple', %s) FROM %s" % \
+                       (self.quote(index_table(model)), \
+                        self.quote(model._meta.pk.column), \
+                        " || ' ' || ".join("coalesce(%s, '')" % column \
+                                           for column in columns), \
+                        self.quote(model._meta.db_table)))
+
+    def insert(self, cursor, model, rows):
+        cursor.executemany('INSERT INTO %s (id, document) VALUES (%%s, '
+                           "to_tsvector('simple', %%s))" % \
+                           self.quote(index_table(model)), \
+                           [(row[0], u' '.join(row[1:])) for row in rows])
+
+    def delete(self, cursor, model, ids):
+        cursor.execute('DELETE FROM %s WHERE id IN (%s)' % \
+                       (self.quote(index_table(model)), \
+                        ', '.join(['%s'] * len(ids))), ids)
+
+    def condition(self, model, words):
+        return '%s.%s IN (SELECT id FROM %s WHERE document @@ '\
+               "to_tsquery('simple', %%s))" % \
+               (self.quote(model._meta.db_table), \
+                self.quote(model._meta.pk.column), \
+                self.quote(index_table(model))), \
+               [u' & '.join(u'%s:*' % word for word in words)]
+
+
+SEARCH_INDEXES = {
+    'sqlite': SQLiteIndex,
+    'postgresql': PostgreSQLIndex,
+}
+
+
+def index_table(model):
+    return model._meta.db_table + '_search'
+
+
+def search_index(using=DEFAULT_DB_ALIAS):
+    """Return index of database `using` or None if it isn't supported or
+    CHUNKS_SEARCH_INDEX is off"""
+    if not getattr(settings, 'CHUNKS_SEARCH_INDEX', True) \
+            or using in _unsupported:
+        return None
+    connection = connections[using]
+    index_class = SEARCH_INDEXES.get(connection.vendor)
+    if index_class is None:
+        return None
+    return index_class(connection)
+
+
+def index_exists(model, using=DEFAULT_DB_ALIAS):
+    key = (using, index_table(model))
+    exists = _existing.get(key)
+    if exists is None:
+        exists = _existing[key] = index_table(model) in \
+                    connections[using].introspection.table_names()
+    return exists
+
+
+def create_index(models, using=DEFAULT_DB_ALIAS, rebuild=False):
+    """Create missing index tables of `models` and index their rows.
+    Existing tables are emptied and filled again with `rebuild`, so
+    searches see either previous or new index"""
+    index = search_index(using)
+    if index is None:
+        return
+    cursor = connections[using].cursor()
+    for model in models:
+        if rebuild:
+            _existing.pop((using, index_table(model)), None)
+        if not index_exists(model, using):
+            try:
+                index.create(cursor, model)
+            except DatabaseError:
+                logger.warning(u"Search index isn't supported by database "
+                               u"%s, chunks are searched without it" % using,
+                               exc_info=True)
+                transaction.rollback_unless_managed(using=using)
+                _unsupported.add(using)
+                return
+        elif rebuild:
+            index.clear(cursor, model)
+        else:
+            continue
+        index.fill(cursor, model)
+        _existing[(using, index_table(model))] = True
+    transaction.commit_unless_managed(using=using)
+
+
+def update_index(model, objects, using=DEFAULT_DB_ALIAS):
+    """Index saved `objects` of `model`"""
+    index = search_index(using)
+    if index is None or not index_exists(model, using):
+        return
+    rows = [[obj.pk] + [getattr(obj, name) or u'' \
+                        for name in model.search_fields] \
+            for obj in objects]
+    if not rows:
+        return
+    cursor = connections[using].cursor()
+    index.delete(cursor, model, [row[0] for row in rows])
+    index.insert(cursor, model, rows)
+    transaction.commit_unless_managed(using=using)
+
+
+def remove_from_index(model, ids, using=DEFAULT_DB_ALIAS):
+    index = search_index(using)
+    if index is None or not ids or not index_exists(model, using):
+        return
+    index.delete(connections[using].cursor(), model, list(ids))
+    transaction.commit_unless_managed(using=using)
+
+
+def search_condition(model, query, using=DEFAULT_DB_ALIAS):
+    """Return SQL condition and its parameters which match rows of `model`
+    containing all words of `query` as prefixes. None is returned if the
+    index can't be used"""
+    words = [word.lower() for word in WORD_RE.findall(query)]
+    index = search_index(using)
+    if not words or index is None or not index_exists(model, using):
+        return None
+    return index.condition(model, words)
@@ -0,0 +1,5 @@
+from django.dispatch import Signal
+
+# sent by ChunksMiddleware at the end of request if CHUNKS_INSTRUMENTATION
+# is enabled, `stats` is `chunks.tracking.ChunksStats` instance
+chunks_rendered = Signal(providing_args=['request', 'stats'])
@@ -0,0 +1,274 @@
+"""
+Storages chunks are read from by template tags, `codechunk` and
+`ChunksModel.chunks`. The storage is set with CHUNKS_STORAGE:
+
+ * `chunks.storage.ORMStorage` (default) reads `Chunk` and `InlineChunk`
+   tables
+ * `chunks.storage.SnapshotStorage` reads immutable snapshot file built by
+   `build_chunks_snapshot` command. The file is mapped to memory, so it's
+   shared by all processes, and chunks are looked up with binary search
+   without database or cache round trips.
+
+Chunks are still saved to database, they are read from snapshot after the
+next one is published.
+"""
+import json
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+from itertools import groupby
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db.models import Q
+
+from chunks.models import Chunk, InlineChunk
+
+
+class ChunkStorage(object):
+    """Interface of chunks storages"""
+    def chunks(self, keys):
+        """Return dictionary of chunks with `keys` which exist"""
+        raise NotImplementedError
+
+    def all_chunks(self):
+        """Return iterable of (key, content) pairs of all chunks"""
+        raise NotImplementedError
+
+    def inline_chunks(self, objects, keys=None):
+        """Return dictionary which maps (content_type_id, object_id) pairs of
+        `objects` to lists of their inline chunks sorted by `order`. Only
+        chunks with `keys` are returned if they are provided"""
+        raise NotImplementedError
+
+    def chunk(self, key):
+        """Return chunk with `key` or raise `Chunk.DoesNotExist`"""
+        chunk = self.chunks([key]).get(key)
+        if chunk is None:
+            raise Chunk.DoesNotExist(u"Chunk %s doesn't exist" % key)
+        return chunk
+
+
+class ORMStorage(ChunkStorage):
+    """Reads chunks from database"""
+    def chunks(self, keys):
+        return dict((c.key, c) for c in Chunk.objects.filter(key__in=keys))
+
+    def all_chunks(self):
+        return Chunk.objects.values_list('key', 'content')
+
+    def inline_chunks(self, objects, keys=None):
+        by_type = {}
+        for model_type_id, object_id in objects:
+            by_type.setdefault(model_type_id, set()).add(object_id)
+        if not by_type:
+            return {}
+
+        condition = Q()
+        for model_type_id, object_ids in by_type.items():
+            condition |= Q(content_type=model_type_id, \
+                           object_id__in=object_ids)
+        chunks = InlineChunk.objects.filter(condition)
+        if keys is not None:
+            chunks = chunks.filter(key__in=keys)
+
+        result = {}
+        for ch in chunks:
+            result.setdefault((ch.content_type_id, ch.object_id), []) \
+                  .append(ch)
+        return result
+
+
+# format of snapshot file: header, index of entries sorted by key and data
+# of keys and values. Values are JSON lists
+SNAPSHOT_MAGIC = 'CHNK'
+SNAPSHOT_VERSION = 1
+SNAPSHOT_HEADER = struct.Struct('>4sBI')
+# offset and length of key, offset and length of value
+SNAPSHOT_ENTRY = struct.Struct('>IIII')
+PLAIN_PREFIX = 'c'
+INLINE_PREFIX = 'o'
+OBJECT_ID = struct.Struct('>II')
+
+
+def plain_entry_key(key):
+    return PLAIN_PREFIX + key.encode('utf-8')
+
+
+def inline_entry_key(model_type_id, object_id):
+    return INLINE_PREFIX + OBJECT_ID.pack(model_type_id, object_id)
+
+
+class Snapshot(object):
+    """Read-only memory-mapped snapshot file"""
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.ident = (stat.st_dev, stat.st_ino, stat.st_mtime, stat.st_size)
+        magic, version, self.count = SNAPSHOT_HEADER.unpack_from(self.data, 0)
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            raise ImproperlyConfigured(\
+                        "%s isn't chunks snapshot of version %d" % \
+                        (path, SNAPSHOT_VERSION))
+
+    def entry(self, i):
+        return SNAPSHOT_ENTRY.unpack_from(self.data, \
+                            SNAPSHOT_HEADER.size + i * SNAPSHOT_ENTRY.size)
+
+    def key(self, i):
+        key_offset, key_length, value_offset, value_length = self.entry(i)
+        return self.data[key_offset:key_offset + key_length]
+
+    def value(self, i):
+        key_offset, key_length, value_offset, value_length = self.entry(i)
+        return self.data[value_offset:value_offset + value_length]
+
+    def position(self, key):
+        """Return index of first entry which key isn't less than `key`"""
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.key(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def get(self, key):
+        """Return raw value of entry with `key` or None"""
+        i = self.position(key)
+        if i < self.count and self.key(i) == key:
+            return self.value(i)
+        return None
+
+    def items(self, prefix=''):
+        """Yield (key, raw value) of entries which keys start with `prefix`"""
+        for i in xrange(self.position(prefix), self.count):
+            key = self.key(i)
+            if not key.startswith(prefix):
+                return
+            yield key, self.value(i)
+
+
+def snapshot_chunk(value):
+    chunk_id, key, content, description = json.loads(value)
+    return Chunk(id=chunk_id, key=key, content=content, \
+                 description=description)
+
+
+class SnapshotStorage(ChunkStorage):
+    """Reads chunks from snapshot file at CHUNKS_SNAPSHOT_PATH. The file is
+    replaced atomically by `build_chunks_snapshot`, new version is opened
+    within CHUNKS_SNAPSHOT_CHECK_INTERVAL seconds"""
+    def __init__(self, path=None, check_interval=None):
+        if path is None:
+            path = getattr(settings, 'CHUNKS_SNAPSHOT_PATH', None)
+        if not path:
+            raise ImproperlyConfigured(\
+                        "CHUNKS_SNAPSHOT_PATH is required by SnapshotStorage")
+        if check_interval is None:
+            check_interval = getattr(settings, \
+                                     'CHUNKS_SNAPSHOT_CHECK_INTERVAL', 1)
+        self.path = path
+        self.check_interval = check_interval
+        self._snapshot = None
+        self._checked = 0
+        self._lock = threading.Lock()
+
+    def snapshot(self):
+        now = time.time()
+        if self._snapshot is None or now - self._checked > self.check_interval:
+            with self._lock:
+                try:
+                    stat = os.stat(self.path)
+                except OSError:
+                    raise ImproperlyConfigured(\
+                        "Chunks snapshot %s doesn't exist, build it with "\
+                        "build_chunks_snapshot command" % self.path)
+                ident = (stat.st_dev, stat.st_ino, stat.st_mtime, \
+                         stat.st_size)
+                if self._snapshot is None or self._snapshot.ident != ident:
+                    # previous mapping is released when the last request
+                    # using it is finished
+                    self._snapshot = Snapshot(self.path)
+                self._checked = now
+        return self._snapshot
+
+    def chunks(self, keys):
+        snapshot = self.snapshot()
+        result = {}
+        for key in keys:
+            value = snapshot.get(plain_entry_key(key))
+            if value is not None:
+                result[key] = snapshot_chunk(value)
+        return result
+
+    def all_chunks(self):
+        return [tuple(json.loads(value)[1:3]) for key, value \
+                in self.snapshot().items(PLAIN_PREFIX)]
+
+    def inline_chunks(self, objects, keys=None):
+        snapshot = self.snapshot()
+        result = {}
+        for model_type_id, object_id in set(objects):
+            value = snapshot.get(inline_entry_key(model_type_id, object_id))
+            if value is None:
+                continue
+            chunks = []
+            for chunk_id, key, content, order, desc in json.loads(value):
+                if keys is None or key in keys:
+                    chunks.append(InlineChunk(id=chunk_id, key=key, \
+                            content=content, order=order, desc=desc, \
+                            content_type_id=model_type_id, \
+                            object_id=object_id))
+            if chunks:
+                result[(model_type_id, object_id)] = chunks
+        return result
+
+
+def snapshot_entries():
+    """Yield (key, value) of snapshot entries for all chunks in database"""
+    for c in Chunk.objects.iterator():
+        yield plain_entry_key(c.key), \
+              json.dumps([c.id, c.key, c.content, c.description])
+
+    chunks = InlineChunk.objects.order_by('content_type', 'object_id', 'order')
+    for (model_type_id, object_id), object_chunks in \
+            groupby(chunks.iterator(), \
+                    lambda ch: (ch.content_type_id, ch.object_id)):
+        yield inline_entry_key(model_type_id, object_id), \
+              json.dumps([[ch.id, ch.key, ch.content, ch.order, ch.desc] \
+                          for ch in object_chunks])
+
+
+def write_snapshot(path, entries):
+    """Write snapshot with `entries` to temporary file and move it to `path`
+    atomically, so readers get either previous or new snapshot"""
+    entries = sorted(entries)
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.chunks-snapshot')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, \
+                                         len(entries)))
+            offset = SNAPSHOT_HEADER.size + len(entries) * SNAPSHOT_ENTRY.size
+            for key, value in entries:
+                f.write(SNAPSHOT_ENTRY.pack(offset, len(key), \
+                                            offset + len(key), len(value)))
+                offset += len(key) + len(value)
+            for key, value in entries:
+                f.write(key)
+                f.write(value)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(temp_path, 0644)
+        os.rename(temp_path, path)
+    except:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return len(entries)
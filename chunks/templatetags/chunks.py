@@ -1,13 +1,23 @@
+from __future__ import absolute_import
+
 import logging
 
 from django.contrib.contenttypes.models import ContentType
 from django import template
 from django.db import models
-from django.core.cache import cache
 from django.core.exceptions import ImproperlyConfigured
 from django.conf import settings
 from django.template.defaultfilters import stringfilter
 
+from chunks.caching import chunks_cache, ABSENT, ABSENT_CACHE_TIME
+from chunks.models import queue_chunk, cacheable_content, cached_content, \
+                          chunk_storage, \
+                          chunk_record, absent_record
+from chunks.latebinding import placeholders_enabled, chunk_placeholder, \
+                               object_chunk_placeholder
+from chunks.tracking import track_codechunk, current_stats, \
+                            track_chunk_dependency, track_object_dependency
+
 logger = logging.getLogger(__name__)
 
 register = template.Library()
@@ -35,35 +45,76 @@ class ObjChunkNode(template.Node):
         """
         TODO wrapping
         """
+        stats = current_stats()
         try:
             obj = self.obj.resolve(context)
+            if placeholders_enabled() and obj.pk is not None:
+                return object_chunk_placeholder(obj, self.key, \
+                                    self.cache_time, self.default_chunk)
+            track_object_dependency(obj._meta.app_label, \
+                                    obj._meta.object_name.lower(), obj.id)
+            if self.default_chunk:
+                track_chunk_dependency(self.default_chunk)
+
+            prefetched = getattr(obj, '_prefetched_chunks', None)
+            if prefetched is not None and \
+                    (self.key in prefetched or not self.default_chunk):
+                # chunks are loaded by `prefetch_chunks`
+                if stats is not None:
+                    stats.hit('ObjChunkNode')
+                if self.key not in prefetched:
+                    return ''
+                request = context.get('request', None)
+                if not request:
+                    raise CONTEXT_IMPROPERLY_CONFIGURED()
+                return prefetched[self.key].build_content(\
+                                            request, context, obj=obj)
+
             cache_key = obj.chunk_item_cache_key(self.key)
-            content = cache.get(cache_key)
+            content = chunks_cache.get(cache_key)
+            if stats is not None:
+                if content is None:
+                    stats.miss('ObjChunkNode')
+                else:
+                    stats.hit('ObjChunkNode')
+            if content == ABSENT:
+                return ''
             if content is None:
+                if stats is not None:
+                    stats.lookup('ObjChunkNode')
                 try:
                     model_type = ContentType.objects\
                                     .get_for_model(obj.__class__)
                     object_id = obj.id
 
-                    c = InlineChunk.objects.get(\
-                            content_type=model_type, object_id=object_id, \
-                            key=self.key)
+                    found = chunk_storage().inline_chunks(\
+                            [(model_type.id, object_id)], keys=[self.key])
+                    if not found:
+                        raise InlineChunk.DoesNotExist()
+                    c = found.values()[0][0]
                 except InlineChunk.DoesNotExist:
+                    c = None
                     if self.default_chunk:
+                        if stats is not None:
+                            stats.lookup('ObjChunkNode')
                         try:
-                            c = Chunk.objects.get(key=self.default_chunk)
+                            c = chunk_storage().chunk(self.default_chunk)
                         except Chunk.DoesNotExist:
-                            return ''
-                    else:
+                            pass
+                    if c is None:
+                        # don't look for it again until it's saved
+                        chunks_cache.set(cache_key, ABSENT, ABSENT_CACHE_TIME)
                         return ''
 
                 request = context.get('request', None)
                 if not request:
                     raise CONTEXT_IMPROPERLY_CONFIGURED()
 
-                content = c.build_content(request, context)
-                cache.set(cache_key, content, int(self.cache_time))
+                content = cacheable_content(c, request, context, obj=obj)
+                chunks_cache.set(cache_key, content, int(self.cache_time))
 
+            content = cached_content(content, context.get('request', None), \
+                                     context, obj=obj)
         except (Chunk.DoesNotExist, template.VariableDoesNotExist):
             content = ''
         return content
@@ -108,14 +159,42 @@ class ObjChunksListNode(template.Node):
         return ""
 
 
+class ChunkBatch(object):
+    """Static chunk keys of one compiled template. All of them are fetched
+    together on first render and shared by the template's ChunkNodes for
+    the rest of that render"""
+    def __init__(self):
+        self.keys = {}
+
+    def add(self, key, cache_time):
+        self.keys.setdefault(key, cache_time)
+
+    def fetch(self, context):
+        render_context = getattr(context, 'render_context', None)
+        if render_context is None:
+            return {}
+        records = render_context.get(self)
+        if records is None:
+            records = fetch_chunks(context, self.keys)
+            render_context[self] = records
+        return records
+
+
 class ChunkNode(template.Node):
-    def __init__(self, key, cache_time=0, wrap='True'):
+    def __init__(self, key, cache_time=0, wrap='True', batch=None):
         self.key = key
         self.cache_time = cache_time
         self.wrap = wrap
+        self.batch = batch
 
     def render(self, context):
-        return render_chunk(context, self.key, self.wrap, self.cache_time)
+        if placeholders_enabled():
+            return chunk_placeholder(self.key, self.cache_time)
+        record = None
+        if self.batch is not None:
+            record = self.batch.fetch(context).get(self.key)
+        return render_chunk(context, self.key, self.wrap, self.cache_time, \
+                            record=record)
 
 
 def do_get_chunk(parser, token):
@@ -146,8 +225,16 @@ def do_get_chunk(parser, token):
         raise template.TemplateSyntaxError( \
             "%r tag's argument should be in quotes" % tag_name)
     # Send key without quotes and caching time
+    key = key[1:-1]
 
-    return ChunkNode(key[1:-1], cache_time=cache_time, wrap=wrap)
+    # collect all static keys of the template being compiled to fetch
+    # them with one round trip on render
+    if not hasattr(parser, 'chunk_batch'):
+        parser.chunk_batch = ChunkBatch()
+    parser.chunk_batch.add(key, cache_time)
+
+    return ChunkNode(key, cache_time=cache_time, wrap=wrap, \
+                     batch=parser.chunk_batch)
 
 
 def do_get_object_chunk(parser, token):
@@ -202,14 +289,15 @@ def do_get_object_chunks_list(parser, token):
 
 class CodeChunk(object):
     """
-    The static variable codechunks holds all the codechunks!
+    Chunk rendered from code. Kept for compatibility, rendered code chunks
+    are recorded by `chunks.tracking.track_codechunk`
     """
-    codechunks = []
+    __slots__ = ('key', 'wrap')
 
     def __init__(self, key, wrap=True):
         self.key = key
         self.wrap = wrap
-        CodeChunk.codechunks.append(self)
+        track_codechunk(key, wrap)
 
 
 @stringfilter
@@ -220,50 +308,99 @@ def do_filter_chunk(value, wrap):
     CHUNK_WRAP mode.
     """
 
-    CodeChunk(value, wrap)
+    track_codechunk(value, wrap)
     return render_chunk({}, value, wrap, 0)
 
 
-def render_chunk(context, key, wrap='True', cache_time=100):
+def fetch_chunks(context, keys):
+    """
+    Fetch records of several chunks at once: one `get_many` for all keys
+    and one query for cache misses. `keys` maps chunk key to its cache time.
+    Chunks which don't exist are `ABSENT` in result. They are created only
+    when they are rendered (see `render_chunk`), not when they are fetched.
+    """
+    request = context.get('request', None)
+    cache_keys = dict((Chunk.cache_key(key), key) for key in keys)
+    records = {}
+    for cache_key, record in chunks_cache.get_many(cache_keys.keys()).items():
+        records[cache_keys[cache_key]] = record
+
+    missing = [key for key in keys if key not in records]
+    stats = current_stats()
+    if stats is not None:
+        stats.hit('render_chunk', len(records))
+        stats.miss('render_chunk', len(missing))
+        if missing:
+            stats.lookup('render_chunk')
+    if missing:
+        to_cache = {}
+        for key, c in chunk_storage().chunks(missing).items():
+            record = chunk_record(c, request, context)
+            records[key] = record
+            to_cache.setdefault(int(keys[key]), {})\
+                    [Chunk.cache_key(key)] = record
+        for key in missing:
+            if key not in records:
+                # don't look for it again until it's created
+                records[key] = ABSENT
+                to_cache.setdefault(ABSENT_CACHE_TIME, {})\
+                        [Chunk.cache_key(key)] = ABSENT
+        for cache_time, values in to_cache.items():
+            chunks_cache.set_many(values, cache_time)
+    return records
+
+
+def render_chunk(context, key, wrap='True', cache_time=100, record=None):
     """
     Renders the chunk.
     wrap = True will wrap the chunk in <chunk> tags.
+    `record` is already fetched chunk (see `fetch_chunks`), if any.
     """
-    try:
-        request = context.get('request', None)
-        if not request:
-#            raise CONTEXT_IMPROPERLY_CONFIGURED()
-            pass  # TODO can it be like this?
+    request = context.get('request', None)
+    if not request:
+#        raise CONTEXT_IMPROPERLY_CONFIGURED()
+        pass  # TODO can it be like this?
 
-        cache_key = CACHE_PREFIX + key
-        content = cache.get(cache_key)
+    track_chunk_dependency(key)
+    content = record
+    try:
+        if content is None:
+            cache_key = Chunk.cache_key(key)
+            content = chunks_cache.get(cache_key)
+
+            stats = current_stats()
+            if stats is not None:
+                if content is None:
+                    stats.miss('render_chunk')
+                    stats.lookup('render_chunk')
+                else:
+                    stats.hit('render_chunk')
         if content is None:
-            c = Chunk.objects.get(key=key)
+            c = chunk_storage().chunk(key)
 
-            content = {'id': c.id,
-                        'key': c.key,
-                        'content': c.build_content(request, context),
-                        'description': c.description,
-                      }
-            cache.set(cache_key, content, int(cache_time))
+            content = chunk_record(c, request, context)
+            chunks_cache.set(cache_key, content, int(cache_time))
 
     except Chunk.DoesNotExist:
-        c = Chunk(key=key,
-                  content=key,
-                  description='')
+        # don't look for it again until it's created
+        chunks_cache.set(cache_key, ABSENT, ABSENT_CACHE_TIME)
+        content = ABSENT
 
-        c.save()
+    if content == ABSENT:
+        # rendered chunk is created at the end of request
+        queue_chunk(key)
+        content = absent_record(key)
 
-        content = {'id': c.id,
-                   'key': c.key,
-                   'content': c.build_content(request, context),
-                   'description': c.description,
-                  }
+    # records may be shared by several nodes of one render, so don't
+    # wrap them in place
+    content = dict(content)
+    content['content'] = cached_content(content['content'], request, context)
 
     # if CHUNKS_WRAP is True,
     # wrap the chunk into a <chunk> element with an attribute that
     # contains it's ID
-    if getattr(settings, 'CHUNKS_WRAP', False) and (wrap == 'True' or wrap == True or wrap == 1):
+    if getattr(settings, 'CHUNKS_WRAP', False) and content['id'] \
+            and (wrap == 'True' or wrap == True or wrap == 1):
         content['original'] = content['content']
         content['content'] = '<chunk cid="%d" class="newchunk">%s</chunk><div class="chunkmenu" id="chm_%d"><a class="button" href="%s%d">edit</a></div>' \
                                 % (content['id'],
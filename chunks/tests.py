@@ -1,10 +1,48 @@
+import cPickle as pickle
+import os
+import shutil
+import sys
+import tempfile
+import time
+from StringIO import StringIO
+
 from django.test.testcases import TestCase
-from chunks.models import Chunk, codechunk
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection, models, DatabaseError
+from django.http import HttpRequest, HttpResponse
+from django.test.client import RequestFactory
+from chunks import models as chunks_models
+from chunks.models import Chunk, InlineChunk, ChunksModel, codechunk, \
+                          codechunks, prefetch_chunks, flush_pending_chunks
+from chunks.context_processors import chunks as chunks_processor
+from chunks.caching import LocalCache, ChunksCache, encode_value, \
+                           decode_value
+from chunks.builders import ChunkBuilder, BuilderIndex, BuilderRegistry, \
+                            builders_registry
+from chunks.forms import InlineChunkForm
+from chunks.tracking import start_tracking, stop_tracking, start_stats, \
+                            stop_stats
+from chunks.middleware import ChunksMiddleware
+from chunks.latebinding import start_late_binding, stop_late_binding
+from chunks.storage import SnapshotStorage
+from chunks.decorators import chunks_cache_page
+from chunks.signals import chunks_rendered
+from chunks.admin import ChunkAdmin, InlineChunkAdmin
+from chunks import search
+from chunks.search import search_condition, create_index, index_exists, \
+                          SQLiteIndex
+from django.contrib import admin
 from django.template.base import Template
 from django.template.context import Context
 from django.conf import settings
 
 
+class Page(models.Model, ChunksModel):
+    """Model with inline chunks used by tests"""
+    title = models.CharField(max_length=100)
+
+
 class ChunkTagTestCase(TestCase):
     """
     Tests the template tags
@@ -29,16 +67,52 @@ class ChunkTagTestCase(TestCase):
         # chunk is created and rendered
         rendered = render_template('{% load chunks %}{% chunk "testchunk_not_exists" %}')
         self.assertEqual(rendered, 'testchunk_not_exists')
+        # missing chunks are created at the end of request
+        flush_pending_chunks()
         self.assertEqual(len(Chunk.objects.all()), 2)
 
+    def test_flush_before_close(self):
+        from django.core.signals import request_finished
+        from django.db import close_connection
+        receivers = request_finished._live_receivers(None)
+        self.assertTrue(receivers.index(flush_pending_chunks) <
+                        receivers.index(close_connection))
+
     def test_code_chunk(self):
         rendered = codechunk('testchunk1')
         self.assertEqual(rendered, self.chunk1.content)
 
         rendered = codechunk('testchunk_not_exists_2')
         self.assertEqual(rendered, 'testchunk_not_exists_2')
+        flush_pending_chunks()
         self.assertEqual(len(Chunk.objects.all()), 2)
 
+    def test_code_chunk_tracking(self):
+        # nothing is recorded unless sidebar is enabled for request
+        codechunk('testchunk1')
+        self.assertEqual(stop_tracking(), [])
+
+        start_tracking()
+        codechunk('testchunk1')
+        codechunk('testchunk1', wrap=True)
+        render_template('{% load chunks %}{{ "testchunk2"|chunk:0 }}')
+        self.assertEqual(stop_tracking(), [('testchunk1', False),
+                                           ('testchunk2', 0)])
+        self.assertEqual(stop_tracking(), [])
+
+    def test_missing_chunk_created_once(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(codechunk('Missing Chunk'), 'Missing Chunk')
+        with self.assertNumQueries(0):
+            self.assertEqual(codechunk('Missing Chunk'), 'Missing Chunk')
+
+        flush_pending_chunks()
+        self.assertEqual(Chunk.objects.get(key='missing_chunk').content,
+                         'Missing Chunk')
+        # created already
+        flush_pending_chunks()
+        self.assertEqual(Chunk.objects.filter(key='missing_chunk').count(), 1)
+
     def test_chunk_filter(self):
         # 1 = wrap
         # 0 = don't wrap
@@ -47,8 +121,1155 @@ class ChunkTagTestCase(TestCase):
 
     def test_chunk_caching(self):
         # a cached chunk should not make a database connection
+        cache.clear()
+        render_template('{% load chunks %}{% chunk "testchunk1" %}')
+        with self.assertNumQueries(0):
+            rendered = render_template(
+                            '{% load chunks %}{% chunk "testchunk1" %}')
+        self.assertEqual(rendered, self.chunk1.content)
+
+
+class ChunkBatchTestCase(TestCase):
+    """
+    Tests fetching of all template chunks at once
+    """
+    def setUp(self):
+        for i in range(3):
+            Chunk(key='batch%d' % i, content='content %d' % i,
+                  description='').save()
+        setattr(settings, 'CHUNKS_WRAP', False)
+        cache.clear()
+
+    def test_one_query_per_template(self):
+        t = Template('{% load chunks %}{% chunk "batch0" %}|'
+                     '{% chunk "batch1" %}|{% chunk "batch2" %}|'
+                     '{% chunk "batch0" %}')
+        with self.assertNumQueries(1):
+            rendered = t.render(Context({}))
+        self.assertEqual(rendered,
+                         'content 0|content 1|content 2|content 0')
+
+        # all chunks are cached now
+        with self.assertNumQueries(0):
+            t.render(Context({}))
+
+    def test_only_rendered_chunks_are_created(self):
+        t = Template('{% load chunks %}{% if show %}{% chunk "hidden" %}'
+                     '{% endif %}{% chunk "shown" %}')
+        self.assertEqual(t.render(Context({'show': False})), 'shown')
+        flush_pending_chunks()
+        self.assertEqual(sorted(Chunk.objects.filter(key__in=['hidden',
+                                                              'shown'])
+                                .values_list('key', flat=True)), ['shown'])
+
+
+class ChunksContextProcessorTestCase(TestCase):
+    """
+    Tests lazy CHUNKS mapping
+    """
+    def setUp(self):
+        Chunk(key='processed', content='first', description='').save()
+
+    def test_lazy_snapshot(self):
+        with self.assertNumQueries(0):
+            context = chunks_processor(None)
+
+        self.assertEqual(context['CHUNKS']['processed'], 'first')
+        # snapshot is reused until some chunk is changed
+        with self.assertNumQueries(0):
+            self.assertEqual(chunks_processor(None)['CHUNKS'].get('processed'),
+                             'first')
+
+        Chunk.objects.filter(key='processed').update(content='second')
+        Chunk.objects.get(key='processed').save()
+        self.assertEqual(chunks_processor(None)['CHUNKS']['processed'],
+                         'second')
+
+
+class LocalCacheTestCase(TestCase):
+    """
+    Tests in-process LRU cache
+    """
+    def test_lru(self):
+        local = LocalCache(2, staleness=0)
+        local.set('a', 1)
+        local.set('b', 2)
+        self.assertEqual(local.get('a'), 1)
+        local.set('c', 3)
+        # 'b' is least recently used
+        self.assertEqual(local.get('b'), None)
+        self.assertEqual(local.get('c'), 3)
+        self.assertEqual(local.stats(), {'hits': 2, 'misses': 1,
+                                         'evictions': 1, 'size': 2})
+
+    def test_invalidated_by_chunk_save(self):
+        local = LocalCache(10, staleness=0)
+        local.set('a', 1)
+        self.assertEqual(local.get('a'), 1)
+        Chunk(key='local', content='', description='').save()
+        self.assertEqual(local.get('a'), None)
+
+
+class PrefetchChunksTestCase(TestCase):
+    """
+    Tests loading of inline chunks for list of objects
+    """
+    def setUp(self):
+        self.pages = [Page.objects.create(title='page %d' % i)
+                      for i in range(3)]
+        for page in self.pages[:2]:
+            for key in ('teaser', 'body'):
+                InlineChunk(content_object=page, key=key,
+                            content='%s of %s' % (key, page.title)).save()
+        cache.clear()
+
+    def test_prefetch(self):
+        # pages and all their chunks
+        with self.assertNumQueries(2):
+            pages = prefetch_chunks(Page.objects.order_by('id'))
+
+        t = Template('{% load chunks %}{% for p in pages %}'
+                     '{% object_chunk p "teaser" %}|'
+                     '{% object_chunks_list p "c" %}{{ c.body }};'
+                     '{% endfor %}')
+        with self.assertNumQueries(0):
+            rendered = t.render(Context({'pages': pages,
+                                         'request': HttpRequest()}))
+        self.assertEqual(rendered, 'teaser of page 0|body of page 0;'
+                                   'teaser of page 1|body of page 1;|;')
+
+
+class ObjectChunksCacheTestCase(TestCase):
+    """
+    Tests invalidation of object chunks cache
+    """
+    def setUp(self):
+        self.page = Page.objects.create(title='page')
+        InlineChunk(content_object=self.page, key='teaser',
+                    content='old').save()
+        cache.clear()
+
+    def render(self):
+        t = Template('{% load chunks %}{% object_chunk page "teaser" 0 60 %}')
+        return t.render(Context({'page': self.page,
+                                 'request': HttpRequest()}))
+
+    def test_invalidation(self):
+        self.assertEqual(self.render(), 'old')
+        InlineChunk.objects.filter(key='teaser').update(content='new')
+        self.assertEqual(self.render(), 'old')
+
+        with self.assertNumQueries(0):
+            self.page.clear_chunks_cache()
+        self.assertEqual(self.render(), 'new')
+
+        InlineChunk.objects.filter(key='teaser').update(content='newer')
+        Page.clear_model_chunks_cache()
+        self.assertEqual(self.render(), 'newer')
+
+    def test_absent_chunks(self):
+        page = Page.objects.create(title='empty')
+        t = Template('{% load chunks %}{% object_chunk page "teaser" 0 60 %}'
+                     '{% object_chunks_list page "c" %}{{ c.teaser }}')
+        context = {'page': page, 'request': HttpRequest()}
+        self.assertEqual(t.render(Context(context)), '')
+        # missing chunks are cached too
+        with self.assertNumQueries(0):
+            self.assertEqual(t.render(Context(context)), '')
+
+        InlineChunk(content_object=page, key='teaser', content='added').save()
+        self.assertEqual(t.render(Context(context)), 'addedadded')
+
+    def test_key_length(self):
+        key = self.page.chunk_item_cache_key('x' * 255)
+        self.assertEqual(len(key), len(self.page.chunk_item_cache_key('x')))
+        self.assertTrue(len(Chunk.cache_key('x' * 255)) < 250)
+
+
+class StampedeProtectionTestCase(TestCase):
+    """
+    Tests serving of stale values while one process rebuilds them
+    """
+    def setUp(self):
+        cache.clear()
+
+    def test_stale_value(self):
+        chunks_cache = ChunksCache(cache, stale_time=60)
+        chunks_cache.set('stampede', 'old', -1)
+        # soft expired value is rebuilt by first caller only
+        self.assertEqual(chunks_cache.get('stampede'), None)
+        self.assertEqual(chunks_cache.get('stampede'), 'old')
+        self.assertEqual(chunks_cache.get_many(['stampede']),
+                         {'stampede': 'old'})
+
+        chunks_cache.set('stampede', 'new', 60)
+        self.assertEqual(chunks_cache.get('stampede'), 'new')
+
+    def test_jitter(self):
+        timeouts = {}
+
+        class Backend(object):
+            def set_many(self, data, timeout):
+                for key in data:
+                    timeouts[key] = timeout
+
+        chunks_cache = ChunksCache(Backend(), jitter=0.5)
+        chunks_cache.set_many(dict(('key%d' % i, i) for i in range(100)),
+                              100)
+        # values written at once don't expire at once
+        self.assertTrue(len(set(timeouts.values())) > 1)
+        self.assertTrue(len(set(timeouts.values())) <=
+                        ChunksCache.JITTER_BUCKETS)
+        self.assertTrue(all(100 <= t <= 150 for t in timeouts.values()))
+
+
+class CompactValuesTestCase(TestCase):
+    """
+    Tests compact and compressed format of cached values
+    """
+    def setUp(self):
+        cache.clear()
+
+    def test_record(self):
+        record = {'id': 1, 'key': 'footer', 'content': u'F\xf6oter',
+                  'description': ''}
+        encoded = encode_value(record)
+        self.assertTrue(len(encoded) < len(pickle.dumps(record, 2)))
+        self.assertEqual(decode_value(encoded), record)
+
+    def test_compression(self):
+        chunks_cache = ChunksCache(cache, stale_time=60, encode=True,
+                                   compress_threshold=100)
+        content = u'<p>content</p>' * 100
+        chunks_cache.set('large', content, 60)
+        self.assertTrue(len(cache.get('large')) < len(content) / 10)
+        self.assertEqual(chunks_cache.get('large'), content)
+        self.assertEqual(chunks_cache.get_many(['large']), {'large': content})
+
+    def test_old_format(self):
+        # values cached by previous versions are still read
+        record = {'id': 1, 'key': 'footer', 'content': 'Footer',
+                  'description': ''}
+        cache.set('old', record)
+        cache.set('old_string', '\x01content')
+        chunks_cache = ChunksCache(cache, encode=True)
+        self.assertEqual(chunks_cache.get('old'), record)
+        self.assertEqual(chunks_cache.get('old_string'), '\x01content')
+
+
+class NamedBuilder(ChunkBuilder):
+    ident = u'named'
+    chunk_names = ['intro']
+
+
+class MarkerBuilder(ChunkBuilder):
+    ident = u'marker'
+    content_marker = True
+
+
+class CustomBuilder(ChunkBuilder):
+    ident = u'custom'
+
+    def appropriate_key(self, name, chunk=None, obj=None):
+        return name.startswith('custom')
+
+
+class BuilderIndexTestCase(TestCase):
+    """
+    Tests that index finds the same builder as linear scan
+    """
+    def setUp(self):
+        self.builders = [NamedBuilder(), CustomBuilder(), MarkerBuilder(),
+                         ChunkBuilder()]
+        self.index = BuilderIndex(self.builders)
+
+    def scan(self, chunk):
+        for builder in self.builders:
+            if builder.appropriate_key(chunk.key, chunk=chunk):
+                return builder
+
+    def test_resolve(self):
+        for key, content in (('intro', 'chunk=marker'),
+                             ('custom_intro', 'chunk=marker'),
+                             ('other', 'text chunk=marker text'),
+                             ('other', 'chunk=marke'),
+                             ('custom', '')):
+            chunk = Chunk(key=key, content=content)
+            self.assertEqual(self.index.resolve(key, chunk=chunk),
+                             self.scan(chunk))
+
+    def test_resolved_once(self):
+        index = chunks_models.CHUNK_BUILDERS_INDEX
+        chunks_models.CHUNK_BUILDERS_INDEX = self.index
+        resolved = []
+
+        def resolve(name, chunk=None, obj=None):
+            resolved.append(name)
+            return BuilderIndex.resolve(self.index, name, chunk=chunk,
+                                        obj=obj)
+        self.index.resolve = resolve
+        try:
+            chunk = Chunk(key='other', content='text chunk=marker')
+            chunks_models.cacheable_content(chunk, HttpRequest(), {})
+            self.assertEqual(resolved, ['other'])
+        finally:
+            chunks_models.CHUNK_BUILDERS_INDEX = index
+        self.assertEqual(self.index.builder_by_ident(u'marker'),
+                         self.builders[2])
+
+
+class LanguageBuilder(ChunkBuilder):
+    ident = u'language'
+    cache_timeout = 60
+    cache_vary_on = ('request.LANGUAGE_CODE',)
+    cache_invalidate_on = ('chunks.page',)
+
+    def __init__(self):
+        self.renders = 0
+
+    def render(self, request, chunk, parent=None, context={}):
+        self.renders += 1
+        return u'%s %s' % (chunk.content, request.LANGUAGE_CODE)
+
+
+class BuilderCacheTestCase(TestCase):
+    """
+    Tests cache policy of builders
+    """
+    def setUp(self):
+        cache.clear()
+        self.registry = BuilderRegistry(['chunks.tests.LanguageBuilder'])
+        self.registry.connect()
+        self.builder = self.registry[0]
+        self.chunk = Chunk.objects.create(key='lang', content='hello')
+
+    def tearDown(self):
+        self.registry.disconnect()
+
+    def render(self, language):
+        request = HttpRequest()
+        request.LANGUAGE_CODE = language
+        return self.builder.cached_render(request, self.chunk, context={})
+
+    def test_vary_and_invalidate(self):
+        self.assertEqual(self.render('en'), 'hello en')
+        self.assertEqual(self.render('uk'), 'hello uk')
+        self.assertEqual(self.render('en'), 'hello en')
+        self.assertEqual(self.builder.renders, 2)
+
+        Page.objects.create(title='invalidates')
+        self.assertEqual(self.render('en'), 'hello en')
+        self.assertEqual(self.builder.renders, 3)
+
+        # saves of other models don't drop it
+        Chunk.objects.create(key='other', content='')
+        self.assertEqual(self.render('en'), 'hello en')
+        self.assertEqual(self.builder.renders, 3)
+
+    def test_dynamic_content(self):
+        index = chunks_models.CHUNK_BUILDERS_INDEX
+        chunks_models.CHUNK_BUILDERS_INDEX = self.registry
+        try:
+            request = HttpRequest()
+            request.LANGUAGE_CODE = 'en'
+            value = chunks_models.cacheable_content(self.chunk, request, {})
+            self.assertEqual(value[-1], u'language')
+            # builder is found by ident, content isn't searched again
+            self.registry.index.resolve = None
+            self.assertEqual(chunks_models.cached_content(value, request, {}),
+                             'hello en')
+        finally:
+            chunks_models.CHUNK_BUILDERS_INDEX = index
+
+    def test_invalidate_without_loading(self):
+        self.assertEqual(self.render('en'), 'hello en')
+        # e.g. admin process which never rendered chunks
+        self.registry.disconnect()
+        builders_registry.disconnect()
+        other = BuilderRegistry(['chunks.tests.LanguageBuilder'])
+        other.connect()
+        try:
+            Page.objects.create(title='invalidates')
+        finally:
+            other.disconnect()
+            builders_registry.connect()
+        self.assertFalse(other.loaded)
+        self.assertEqual(self.render('en'), 'hello en')
+        self.assertEqual(self.builder.renders, 2)
+
+    def test_content_key(self):
+        request = HttpRequest()
+        request.LANGUAGE_CODE = 'en'
+        key = self.builder.cache_key(request, self.chunk)
+        self.chunk.content = u'hello'
+        self.assertEqual(self.builder.cache_key(request, self.chunk), key)
+        self.chunk.content = u'h\xe9llo'
+        self.assertNotEqual(self.builder.cache_key(request, self.chunk), key)
+
+
+class SlowBuilder(ChunkBuilder):
+    ident = u'slow'
+    chunk_names = ['slow', 'broken']
+    thread_safe = True
+    render_timeout = 0.2
+
+    def render(self, request, chunk, parent=None, context={}):
+        if chunk.key == 'broken':
+            raise ValueError(chunk.key)
+        time.sleep(float(chunk.content))
+        return u'built %s' % chunk.content
+
+
+class ConcurrentBuildersTestCase(TestCase):
+    """
+    Tests rendering of object chunks in pool threads
+    """
+    def setUp(self):
+        cache.clear()
+        self.index = chunks_models.CHUNK_BUILDERS_INDEX
+        chunks_models.CHUNK_BUILDERS_INDEX = BuilderIndex([SlowBuilder(),
+                                                           ChunkBuilder()])
+        self.threads = chunks_models.BUILDER_THREADS
+        chunks_models.BUILDER_THREADS = 4
+        self.page = Page.objects.create(title='page')
+
+    def tearDown(self):
+        chunks_models.CHUNK_BUILDERS_INDEX = self.index
+        chunks_models.BUILDER_THREADS = self.threads
+
+    def test_fallback(self):
+        chunks = [InlineChunk(content_object=self.page, key=key,
+                              content=content)
+                  for key, content in (('slow', '0.05'), ('broken', '0'),
+                                       ('plain', 'text'))]
+        content, failed = chunks_models.build_chunks(chunks, HttpRequest(),
+                                                     {}, obj=self.page)
+        self.assertEqual(content, {'slow': 'built 0.05', 'broken': '0',
+                                   'plain': 'text'})
+        self.assertEqual(failed, set(['broken']))
+
+        chunks[0].content = '1'
+        content, failed = chunks_models.build_chunks(chunks[:1],
+                                                     HttpRequest(), {},
+                                                     obj=self.page)
+        self.assertEqual(content, {'slow': '1'})
+        self.assertEqual(failed, set(['slow']))
+
+    def test_stats(self):
+        chunk = InlineChunk(content_object=self.page, key='slow',
+                            content='0.05')
+        start_stats()
+        try:
+            chunks_models.build_chunks([chunk], HttpRequest(), {},
+                                       obj=self.page)
+        finally:
+            stats = stop_stats()
+        self.assertTrue(stats.builders['slow'] >= 0.05)
+
+    def test_busy_pool(self):
+        chunk = InlineChunk(content_object=self.page, key='slow',
+                            content='0.3')
+        # all pool threads are taken by builders which timed out
+        with chunks_models._builders_pool_lock:
+            chunks_models._pool_tasks += chunks_models.BUILDER_THREADS
+        try:
+            content, failed = chunks_models.build_chunks(\
+                                    [chunk], HttpRequest(), {}, obj=self.page)
+        finally:
+            with chunks_models._builders_pool_lock:
+                chunks_models._pool_tasks -= chunks_models.BUILDER_THREADS
+        self.assertEqual(content, {'slow': 'built 0.3'})
+        self.assertFalse(failed)
+
+    def test_write_through_fallback(self):
+        setattr(settings, 'CHUNKS_WRITE_THROUGH', True)
+        try:
+            InlineChunk(content_object=self.page, key='broken',
+                        content='0').save()
+            InlineChunk(content_object=self.page, key='plain',
+                        content='text').save()
+        finally:
+            setattr(settings, 'CHUNKS_WRITE_THROUGH', False)
+        # raw content of failed builder isn't cached
+        self.assertEqual(cache.get(self.page.chunk_item_cache_key('broken')),
+                         None)
+        self.assertEqual(cache.get(self.page.chunk_item_cache_key('plain')),
+                         'text')
+
+
+class ChunksMiddlewareTestCase(TestCase):
+    """
+    Tests chunks sidebar
+    """
+    def setUp(self):
+        Chunk(key='sidebar', content='side', description='').save()
+        setattr(settings, 'CHUNKS_WRAP', True)
+        cache.clear()
+
+    def tearDown(self):
+        setattr(settings, 'CHUNKS_WRAP', False)
+
+    def process(self, response):
+        middleware = ChunksMiddleware()
+        request = HttpRequest()
+        middleware.process_request(request)
+        codechunk('sidebar')
+        codechunk('sidebar_missing')
+        codechunk('testchunk1')
+        cache.clear()
+        # all code chunks are fetched at once
+        with self.assertNumQueries(1):
+            return middleware.process_response(request, response)
+
+    def test_buffered(self):
+        response = self.process(HttpResponse('<body>page</body></html>'))
+        self.assertTrue(response.content.startswith('<body>page\n\t<div'))
+        self.assertTrue(response.content.endswith('</div>\n</body></html>'))
+        self.assertTrue('<strong>sidebar</strong>' in response.content)
+        self.assertFalse('sidebar_missing' in response.content)
+
+    def test_streaming(self):
+        response = self.process(HttpResponse(iter(['<body>', 'x' * 10000,
+                                                   '</bo', 'dy>'])))
+        content = ''.join(response)
+        self.assertTrue(content.startswith('<body>' + 'x' * 10000 + \
+                                           '\n\t<div'))
+        self.assertTrue(content.endswith('</div>\n</body>'))
+
+
+class InstrumentationTestCase(TestCase):
+    """
+    Tests per-request chunks stats
+    """
+    def setUp(self):
+        Chunk(key='measured', content='m', description='').save()
+        setattr(settings, 'CHUNKS_INSTRUMENTATION', True)
+        cache.clear()
+
+    def tearDown(self):
+        setattr(settings, 'CHUNKS_INSTRUMENTATION', False)
+
+    def test_stats(self):
+        received = []
+
+        def receiver(sender, request, stats, **kwargs):
+            received.append(stats.as_dict())
+        chunks_rendered.connect(receiver)
+
+        middleware = ChunksMiddleware()
+        request = HttpRequest()
+        recorded = len(connection.queries)
+        middleware.process_request(request)
+        codechunk('measured')
+        codechunk('measured')
+        response = middleware.process_response(request, HttpResponse())
+        chunks_rendered.disconnect(receiver)
+        # queries recorded only for stats aren't kept without DEBUG
+        self.assertEqual(len(connection.queries), recorded)
+
+        self.assertEqual(received[0]['paths'], {'render_chunk': {
+                                    'hits': 1, 'misses': 1, 'lookups': 1}})
+        # default chunk is looked up with a single query
+        self.assertEqual(received[0]['queries'], 1)
+        self.assertTrue('queries=1' in response['Server-Timing'])
+        self.assertTrue('base' in received[0]['builders'])
+        self.assertTrue(response['Server-Timing'].startswith('chunks;dur='))
+
+        # nothing is collected outside of request
+        codechunk('measured')
+        self.assertEqual(len(received), 1)
+
+
+class WarmChunksCommandTestCase(TestCase):
+    """
+    Tests populating cache by warm_chunks command
+    """
+    def setUp(self):
+        Chunk(key='news.title', content='News').save()
+        Chunk(key='footer', content='Footer').save()
+        self.pages = [Page.objects.create(title='page %d' % i)
+                      for i in range(3)]
+        for page in self.pages:
+            InlineChunk(content_object=page, key='teaser',
+                        content='teaser of %s' % page.title).save()
+        cache.clear()
+
+    def render(self):
+        t = Template('{% load chunks %}{% chunk "news.title" %}'
+                     '{% chunk "footer" %}{% for p in pages %}|'
+                     '{% object_chunk p "teaser" 0 60 %}{% endfor %}')
+        return t.render(Context({'pages': self.pages,
+                                 'request': HttpRequest()}))
+
+    def test_warm(self):
+        call_command('warm_chunks', workers=2, batch_size=1,
+                     stdout=StringIO())
+        with self.assertNumQueries(0):
+            self.assertEqual(self.render(), 'NewsFooter|teaser of page 0'
+                                            '|teaser of page 1'
+                                            '|teaser of page 2')
+
+    def test_prefix(self):
+        call_command('warm_chunks', prefixes='news.', skip_inline=True,
+                     stdout=StringIO())
+        # only footer is loaded, inline chunks are loaded per object
+        with self.assertNumQueries(4):
+            self.render()
+
+
+class PathBuilder(ChunkBuilder):
+    ident = u'path'
+    chunk_names = ['path']
+
+    def render(self, request, chunk, parent=None, context={}):
+        return u'%s %s' % (chunk.content, request.path)
+
+
+class WriteThroughTestCase(TestCase):
+    """
+    Tests putting saved chunks into cache
+    """
+    def setUp(self):
+        setattr(settings, 'CHUNKS_WRITE_THROUGH', True)
+        self.page = Page.objects.create(title='page')
+        cache.clear()
+
+    def tearDown(self):
+        setattr(settings, 'CHUNKS_WRITE_THROUGH', False)
+
+    def test_request_builder(self):
+        index = chunks_models.CHUNK_BUILDERS_INDEX
+        chunks_models.CHUNK_BUILDERS_INDEX = BuilderIndex([PathBuilder(),
+                                                           ChunkBuilder()])
+        try:
+            InlineChunk(content_object=self.page, key='path',
+                        content='at').save()
+            # built on request instead of save
+            t = Template('{% load chunks %}{% object_chunk page "path" %}')
+            request = HttpRequest()
+            request.path = '/page/'
+            self.assertEqual(t.render(Context({'page': self.page,
+                                               'request': request})),
+                             'at /page/')
+        finally:
+            chunks_models.CHUNK_BUILDERS_INDEX = index
+
+    def test_chunk(self):
+        t = Template('{% load chunks %}{% chunk "footer" %}')
+        context = {'request': HttpRequest()}
+        self.assertEqual(t.render(Context(context)), 'footer')
+
+        chunk = Chunk.objects.create(key='footer', content='Footer')
+        with self.assertNumQueries(0):
+            self.assertEqual(t.render(Context(context)), 'Footer')
+
+        chunk.content = 'New footer'
+        chunk.save()
+        with self.assertNumQueries(0):
+            self.assertEqual(t.render(Context(context)), 'New footer')
+
+    def test_inline_chunk(self):
+        t = Template('{% load chunks %}{% object_chunk page "teaser" 0 60 %}'
+                     '|{% object_chunk page "body" 0 60 %}')
+        context = {'page': self.page, 'request': HttpRequest()}
+        InlineChunk(content_object=self.page, key='teaser',
+                    content='teaser').save()
+        InlineChunk(content_object=self.page, key='body',
+                    content='body').save()
+        with self.assertNumQueries(0):
+            self.assertEqual(t.render(Context(context)), 'teaser|body')
+
+
+class PageCacheTestCase(TestCase):
+    """
+    Tests caching of pages until chunks they use are changed
+    """
+    def setUp(self):
+        setattr(settings, 'CHUNKS_WRAP', False)
+        self.footer = Chunk.objects.create(key='footer', content='Footer')
+        self.other = Chunk.objects.create(key='other', content='Other')
+        self.page = Page.objects.create(title='page')
+        self.teaser = InlineChunk(content_object=self.page, key='teaser',
+                                  content='Teaser')
+        self.teaser.save()
+        cache.clear()
+        self.renders = 0
+
+        template = Template('{% load chunks %}{% chunk "footer" %}|'
+                            '{% object_chunk page "teaser" 0 60 %}')
+
+        @chunks_cache_page(60)
+        def view(request):
+            self.renders += 1
+            return HttpResponse(template.render(Context({
+                                    'page': self.page, 'request': request})))
+        self.view = view
+
+    def get(self, **headers):
+        return self.view(RequestFactory().get('/page/', **headers))
+
+    def test_invalidation(self):
+        self.assertEqual(self.get().content, 'Footer|Teaser')
+        self.assertEqual(self.get().content, 'Footer|Teaser')
+        self.assertEqual(self.renders, 1)
+
+        self.other.content = 'Changed'
+        self.other.save()
+        self.get()
+        self.assertEqual(self.renders, 1)
+
+        self.footer.content = 'New footer'
+        self.footer.save()
+        self.assertEqual(self.get().content, 'New footer|Teaser')
+        self.assertEqual(self.renders, 2)
+
+        self.teaser.content = 'New teaser'
+        self.teaser.save()
+        self.assertEqual(self.get().content, 'New footer|New teaser')
+        self.assertEqual(self.renders, 3)
+
+    def test_vary(self):
+        template = Template('{% load chunks %}{% chunk "footer" %} '
+                            '{{ request.META.HTTP_ACCEPT_LANGUAGE }}')
+
+        @chunks_cache_page(60)
+        def view(request):
+            self.renders += 1
+            response = HttpResponse(template.render(Context({
+                                        'request': request})))
+            response['Vary'] = 'Accept-Language'
+            return response
+
+        def get(language):
+            return view(RequestFactory().get(
+                            '/page/', HTTP_ACCEPT_LANGUAGE=language)).content
+
+        self.assertEqual(get('en'), 'Footer en')
+        self.assertEqual(get('uk'), 'Footer uk')
+        self.assertEqual(get('en'), 'Footer en')
+        self.assertEqual(self.renders, 2)
+
+    def test_builders_invalidation(self):
+        registry = BuilderRegistry(['chunks.tests.LanguageBuilder'])
+        registry.connect()
+        registry.resolve('footer')
+        try:
+            self.get()
+            Page.objects.create(title='other')
+            self.get()
+            self.assertEqual(self.renders, 2)
+        finally:
+            registry.disconnect()
+
+    def test_etag(self):
+        etag = self.get()['ETag']
+        self.assertEqual(self.get()['ETag'], etag)
+        self.assertEqual(self.get(HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        self.footer.content = 'New footer'
+        self.footer.save()
+        response = self.get(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+
+class LateBindingTestCase(TestCase):
+    """
+    Tests placeholders replaced with chunks by middleware
+    """
+    def setUp(self):
+        setattr(settings, 'CHUNKS_WRAP', False)
+        setattr(settings, 'CHUNKS_LATE_BINDING', True)
+        self.footer = Chunk.objects.create(key='footer', content=u'F\xf6oter')
+        self.page = Page.objects.create(title='page')
+        self.teaser = InlineChunk(content_object=self.page, key='teaser',
+                                  content='Teaser')
+        self.teaser.save()
+        cache.clear()
+
+    def tearDown(self):
+        setattr(settings, 'CHUNKS_LATE_BINDING', False)
+
+    def render(self, template, page):
+        # as in view called by ChunksMiddleware
+        start_late_binding()
+        try:
+            context = Context({'page': page, 'request': HttpRequest()})
+            return Template(template).render(context)
+        finally:
+            stop_late_binding()
+
+    def resolve(self, html):
+        response = HttpResponse(html)
+        request = HttpRequest()
+        middleware = ChunksMiddleware()
+        middleware.process_request(request)
+        return middleware.process_response(request, response).content
+
+    def test_placeholders(self):
+        html = self.render('{% load chunks %}<p>{% chunk "footer" %}|'
+                           '{% object_chunk page "teaser" 0 60 %}|'
+                           '{% object_chunk page "body" 0 60 "footer" %}|'
+                           '{% chunk "missing key" %}</p>', self.page)
+        self.assertFalse('Teaser' in html)
+        expected = u'<p>F\xf6oter|Teaser|F\xf6oter|missing key</p>'
+        self.assertEqual(self.resolve(html).decode('utf-8'), expected)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(self.resolve(html).decode('utf-8'), expected)
+
+        # rendered page stays valid after chunks are changed
+        self.footer.content = 'Footer'
+        self.footer.save()
+        self.teaser.content = 'New teaser'
+        self.teaser.save()
+        self.assertEqual(self.resolve(html),
+                         '<p>Footer|New teaser|Footer|missing key</p>')
+
+    def test_invalid_placeholders(self):
+        from chunks.latebinding import placeholder
+        html = '|'.join([
+            # forged by user content
+            '<!--chunk:c:0:forged:0123456789abcdef-->',
+            # malformed and unknown, though signed
+            placeholder('o:0:chunks:page:None:teaser:'),
+            placeholder('o:0:chunks:unknown:1:teaser:'),
+            placeholder('c:0:%ff'),
+            placeholder('c:0:footer')])
+        self.assertEqual(self.resolve(html).decode('utf-8'),
+                         html.replace(placeholder('c:0:footer'),
+                                      'F\xc3\xb6oter').decode('utf-8'))
+        flush_pending_chunks()
+        self.assertFalse(Chunk.objects.filter(key='forged').exists())
+
+    def test_missing_default_chunk(self):
+        html = self.render('{% load chunks %}'
+                           '{% object_chunk page "body" 0 60 "missing" %}',
+                           self.page)
+        self.assertEqual(self.resolve(html), '')
+        # default chunks aren't created, as without late binding
+        flush_pending_chunks()
+        self.assertFalse(Chunk.objects.filter(key='missing').exists())
+
+    def test_unsaved_object(self):
+        self.assertEqual(self.render('{% load chunks %}'
+                                     '{% object_chunk page "teaser" %}',
+                                     Page(title='new')), '')
+
+    def test_outside_middleware(self):
+        t = Template('{% load chunks %}Hi {% chunk "footer" %} '
+                     '{% object_chunk page "teaser" %}')
+        self.assertEqual(t.render(Context({'page': self.page,
+                                           'request': HttpRequest()})),
+                         u'Hi F\xf6oter Teaser')
+
+        # AJAX responses aren't HTML pages to resolve
+        request = HttpRequest()
+        request.META['HTTP_X_REQUESTED_WITH'] = 'XMLHttpRequest'
+        middleware = ChunksMiddleware()
+        middleware.process_request(request)
+        self.assertEqual(t.render(Context({'page': self.page,
+                                           'request': request})),
+                         u'Hi F\xf6oter Teaser')
+        middleware.process_response(request, HttpResponse())
+
+
+class SnapshotStorageTestCase(TestCase):
+    """
+    Tests reading chunks from snapshot file
+    """
+    def setUp(self):
+        setattr(settings, 'CHUNKS_WRAP', False)
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'chunks.snapshot')
+        Chunk.objects.create(key='footer', content=u'F\xf6oter')
+        Chunk.objects.create(key='header', content='Header')
+        self.page = Page.objects.create(title='page')
+        InlineChunk(content_object=self.page, key='teaser',
+                    content='Teaser').save()
+        self.build()
+        self.storage = chunks_models._chunk_storage
+        chunks_models._chunk_storage = SnapshotStorage(self.path,
+                                                       check_interval=0)
+        cache.clear()
+
+    def tearDown(self):
+        chunks_models._chunk_storage = self.storage
+        shutil.rmtree(self.directory)
+
+    def build(self):
+        call_command('build_chunks_snapshot', output=self.path,
+                     stdout=StringIO())
+
+    def render(self):
+        t = Template('{% load chunks %}{% chunk "footer" %}|'
+                     '{% chunk "header" %}|'
+                     '{% object_chunk page "teaser" 0 60 %}|'
+                     '{% object_chunk page "body" 0 60 "header" %}')
+        return t.render(Context({'page': self.page,
+                                 'request': HttpRequest()}))
+
+    def test_snapshot(self):
+        with self.assertNumQueries(0):
+            self.assertEqual(self.render(), u'F\xf6oter|Header|Teaser|Header')
+
+        # changes are read after next snapshot is published
+        Chunk.objects.filter(key='footer').update(content='Footer')
+        InlineChunk.objects.filter(key='teaser').update(content='New teaser')
+        self.assertEqual(self.render(), u'F\xf6oter|Header|Teaser|Header')
+        self.build()
+        self.assertEqual(self.render(), u'Footer|Header|New teaser|Header')
+
+    def test_lookup(self):
+        storage = chunks_models._chunk_storage
+        self.assertEqual(sorted(storage.chunks(['header', 'footer',
+                                                'missing'])),
+                         ['footer', 'header'])
+        self.assertRaises(Chunk.DoesNotExist, storage.chunk, 'missing')
+        self.assertEqual(sorted(key for key, content
+                                in storage.all_chunks()),
+                         ['footer', 'header'])
+
+
+class BuilderRegistryTestCase(TestCase):
+    """
+    Tests lazy loading of builders
+    """
+    def test_lazy_loading(self):
+        registry = BuilderRegistry(['chunks.tests.NamedBuilder',
+                                    'project.chunks.tests.MarkerBuilder'])
+        self.assertFalse(registry.loaded)
+        chunk = Chunk(key='intro', content='')
+        self.assertTrue(isinstance(registry.resolve('intro', chunk=chunk),
+                                   NamedBuilder))
+        self.assertTrue(registry.loaded)
+        self.assertEqual(len(registry), 3)
+        self.assertEqual([path for path, seconds in registry.load_times],
+                         ['chunks.tests.NamedBuilder',
+                          'project.chunks.tests.MarkerBuilder'])
+        self.assertTrue('total of 2 builders' in registry.load_report())
+
+    def test_broken_builder_module(self):
+        directory = tempfile.mkdtemp()
+        try:
+            os.mkdir(os.path.join(directory, 'brokenbuilders'))
+            open(os.path.join(directory, 'brokenbuilders',
+                              '__init__.py'), 'w').close()
+            with open(os.path.join(directory, 'brokenbuilders',
+                                   'widgets.py'), 'w') as f:
+                f.write('import missing_dependency\n')
+            sys.path.insert(0, directory)
+            registry = BuilderRegistry(['brokenbuilders.widgets.Widget'])
+            try:
+                registry.resolve('intro')
+            except ImportError, e:
+                self.assertTrue('missing_dependency' in str(e))
+            else:
+                self.fail("ImportError isn't raised")
+        finally:
+            sys.path.remove(directory)
+            shutil.rmtree(directory)
+
+    def test_form_choices(self):
+        form = InlineChunkForm()
+        self.assertEqual(form.fields['chunk_type'].choices,
+                         chunks_models.CHUNK_BUILDERS.choices())
+
+
+class CodeChunksTestCase(TestCase):
+    """
+    Tests rendering of several chunks from code at once
+    """
+    def setUp(self):
+        setattr(settings, 'CHUNKS_WRAP', False)
+        Chunk.objects.create(key='header', content='Header')
+        Chunk.objects.create(key='footer', content='Footer')
+        cache.clear()
+
+    def test_codechunks(self):
+        expected = {'header': 'Header', 'footer': 'Footer',
+                    'sidebar': 'sidebar'}
+        with self.assertNumQueries(1):
+            self.assertEqual(codechunks(['header', 'footer', 'sidebar']),
+                             expected)
+        with self.assertNumQueries(0):
+            self.assertEqual(codechunks(['header', 'footer', 'sidebar']),
+                             expected)
+        # missing chunk is created at the end of request
+        flush_pending_chunks()
+        self.assertTrue(Chunk.objects.filter(key='sidebar').exists())
+
+
+class ImportExportCommandsTestCase(TestCase):
+    """
+    Tests export_chunks and import_chunks commands
+    """
+    def setUp(self):
+        setattr(settings, 'CHUNKS_WRAP', False)
+        Chunk.objects.create(key='header', content='Header')
+        self.page = Page.objects.create(title='page')
+        InlineChunk(content_object=self.page, key='teaser',
+                    content='Teaser').save()
+        self.directory = tempfile.mkdtemp()
+        cache.clear()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def render(self):
+        t = Template('{% load chunks %}{% chunk "header" %}|'
+                     '{% chunk "footer" %}|{% object_chunk page "teaser" %}')
+        return t.render(Context({'page': self.page,
+                                 'request': HttpRequest()}))
+
+    def test_roundtrip(self):
+        self.assertEqual(self.render(), u'Header|footer|Teaser')
+        for format in ('jsonl', 'csv'):
+            path = os.path.join(self.directory, 'chunks.' + format)
+            call_command('export_chunks', output=path, stdout=StringIO())
+            stdout = StringIO()
+            call_command('import_chunks', path, stdout=stdout)
+            self.assertTrue('Created 0 and updated 2' in stdout.getvalue())
+        self.assertEqual(Chunk.objects.count(), 1)
+        self.assertEqual(InlineChunk.objects.count(), 1)
+
+    def test_import(self):
+        self.assertEqual(self.render(), u'Header|footer|Teaser')
+        path = os.path.join(self.directory, 'chunks.jsonl')
+        with open(path, 'wb') as f:
+            f.write('{"type": "chunk", "key": "Header", '
+                    '"content": "New header"}\n'
+                    '{"type": "chunk", "key": "footer", '
+                    '"content": "F\\u00f6oter"}\n'
+                    '{"type": "inline", "key": "teaser", '
+                    '"model": "chunks.page", '
+                    '"object_id": %d, "content": "New teaser"}\n'
+                    % self.page.id)
+        stdout = StringIO()
+        call_command('import_chunks', path, batch_size=2, stdout=stdout)
+        self.assertTrue('Created 1 and updated 2' in stdout.getvalue())
+        self.assertEqual(Chunk.objects.get(key='footer').content, u'F\xf6oter')
+        self.assertEqual(self.render(), u'New header|F\xf6oter|New teaser')
+        # previous batch is saved
+        path = os.path.join(self.directory, 'invalid.jsonl')
+        with open(path, 'wb') as f:
+            f.write('{"type": "chunk", "key": "first", "content": "First"}\n'
+                    '\n'
+                    '{"type": "inline", "key": "teaser", "model": "no.model",'
+                    ' "object_id": 1, "content": ""}\n')
+        stderr = StringIO()
+        self.assertRaises(SystemExit, call_command, 'import_chunks', path,
+                          batch_size=1, stdout=StringIO(), stderr=stderr)
+        self.assertTrue('Unknown object no.model 1 in line 3'
+                        in stderr.getvalue())
+        self.assertTrue(Chunk.objects.filter(key='first').exists())
+
+        for line, message in (('{"type": "chunk", "content": "x"}',
+                               'Missing key in line 1'),
+                              ('{"type": "chunk", "key": "a", '
+                               '"content": null}',
+                               'Invalid content of a in line 1')):
+            with open(path, 'wb') as f:
+                f.write(line + '\n')
+            stderr = StringIO()
+            self.assertRaises(SystemExit, call_command, 'import_chunks',
+                              path, stdout=StringIO(), stderr=stderr)
+            self.assertTrue(message in stderr.getvalue())
+
+        # search index is updated too
+        where, params = search_condition(Chunk, u'f\xf6oter')
+        self.assertEqual([c.key for c in Chunk.objects.extra(where=[where],
+                                                            params=params)],
+                         ['footer'])
+
+
+class AdminSearchTestCase(TestCase):
+    """
+    Tests search of chunks in admin with full-text index
+    """
+    def setUp(self):
+        Chunk.objects.create(key='news.title', content='Latest news',
+                             description='Title')
+        Chunk.objects.create(key='footer', content=u'Copyright \xa9 Company',
+                             description='Footer')
+        self.pages = [Page.objects.create(title='page %d' % i)
+                      for i in range(3)]
+        for page in self.pages:
+            InlineChunk(content_object=page, key='teaser',
+                        content='teaser of %s' % page.title,
+                        desc='Teaser').save()
+
+    def changelist(self, model_admin, query):
+        request = RequestFactory().get('/', {'q': query})
+        ChangeList = model_admin.get_changelist(request)
+        cl = ChangeList(request, model_admin.model, model_admin.list_display,
+                        model_admin.list_display_links,
+                        model_admin.list_filter, model_admin.date_hierarchy,
+                        model_admin.search_fields,
+                        model_admin.list_select_related,
+                        model_admin.list_per_page,
+                        model_admin.list_max_show_all,
+                        model_admin.list_editable, model_admin)
+        cl.get_results(request)
+        return cl
+
+    def search(self, query):
+        cl = self.changelist(ChunkAdmin(Chunk, admin.site), query)
+        return sorted(c.key for c in cl.result_list)
+
+    def test_index_is_used(self):
+        self.assertTrue(search_condition(Chunk, 'news') is not None)
+        self.assertTrue(search_condition(Chunk, '') is None)
+
+    def test_search(self):
+        self.assertEqual(self.search('news'), ['news.title'])
+        self.assertEqual(self.search('lat'), ['news.title'])
+        self.assertEqual(self.search('COMPANY copyright'), ['footer'])
+        self.assertEqual(self.search('title'), ['news.title'])
+        self.assertEqual(self.search('news footer'), [])
+        self.assertEqual(self.search(''), ['footer', 'news.title'])
+
+    def test_index_sync(self):
+        chunk = Chunk.objects.get(key='footer')
+        chunk.content = 'All rights reserved'
+        chunk.save()
+        self.assertEqual(self.search('company'), [])
+        self.assertEqual(self.search('rights'), ['footer'])
+        chunk.delete()
+        self.assertEqual(self.search('rights'), [])
+
+    def test_rebuild(self):
+        create_index([Chunk, InlineChunk], rebuild=True)
+        self.assertEqual(self.search('news'), ['news.title'])
+        self.assertEqual(self.search('company'), ['footer'])
+
+    def test_unsupported_database(self):
+        def create(self, cursor, model):
+            raise DatabaseError('no such module: fts4')
+        original = SQLiteIndex.create
+        SQLiteIndex.create = create
+        try:
+            # model without index table
+            create_index([Page])
+            self.assertTrue(search_condition(Chunk, 'news') is None)
+            # searched with search_fields
+            self.assertEqual(self.search('news'), ['news.title'])
+            with self.assertNumQueries(0):
+                self.assertFalse(index_exists(Page))
+        finally:
+            SQLiteIndex.create = original
+            search._unsupported.discard('default')
+            search._existing.pop(('default', 'chunks_page_search'), None)
 
-        pass
+    def test_inline_chunks(self):
+        model_admin = InlineChunkAdmin(InlineChunk, admin.site)
+        self.assertEqual(len(self.changelist(model_admin, 'page 1')\
+                                 .result_list), 1)
+        cl = self.changelist(model_admin, 'teaser')
+        # chunks and their pages
+        with self.assertNumQueries(2):
+            self.assertEqual(sorted(unicode(ch) for ch in cl.result_list),
+                             [u'Page object / teaser'] * 3)
 
 
 def render_template(content):
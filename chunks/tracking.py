@@ -0,0 +1,192 @@
+"""Request-local registry of chunks rendered from code, it's used by
+`ChunksMiddleware` to display chunks sidebar, request-local chunks
+instrumentation and recording of chunks used by cached pages"""
+import threading
+from collections import OrderedDict, defaultdict
+
+from django.conf import settings
+from django.db import connections
+
+_local = threading.local()
+
+
+def start_tracking():
+    """Start recording of code chunks in current thread"""
+    _local.codechunks = OrderedDict()
+
+
+def stop_tracking():
+    """Stop recording and return list of recorded (key, wrap) pairs"""
+    codechunks = getattr(_local, 'codechunks', None)
+    _local.codechunks = None
+    if codechunks is None:
+        return []
+    return codechunks.items()
+
+
+def track_codechunk(key, wrap):
+    """Record chunk rendered from code, nothing is done unless recording
+    is started for current request"""
+    codechunks = getattr(_local, 'codechunks', None)
+    if codechunks is not None and key not in codechunks:
+        codechunks[key] = wrap
+
+
+class ChunksDependencies(object):
+    """Chunks used while rendering a page: keys of chunks, objects which
+    inline chunks are used as (app_label, model_name, object_id) and flag
+    whether all chunks are used at once, e.g. with `CHUNKS` variable"""
+    def __init__(self):
+        self.keys = set()
+        self.objects = set()
+        self.all_chunks = False
+
+
+def start_dependencies():
+    """Start recording of chunks used in current thread and return
+    the recorder. Recordings may be nested"""
+    dependencies = ChunksDependencies()
+    recorders = getattr(_local, 'dependencies', None)
+    if recorders is None:
+        recorders = _local.dependencies = []
+    recorders.append(dependencies)
+    return dependencies
+
+
+def stop_dependencies(dependencies):
+    """Stop recording started by `start_dependencies`"""
+    recorders = getattr(_local, 'dependencies', None) or []
+    if dependencies in recorders:
+        recorders.remove(dependencies)
+    return dependencies
+
+
+def track_chunk_dependency(key):
+    for dependencies in getattr(_local, 'dependencies', None) or ():
+        dependencies.keys.add(key)
+
+
+def track_object_dependency(app_label, model_name, object_id):
+    for dependencies in getattr(_local, 'dependencies', None) or ():
+        dependencies.objects.add((app_label, model_name, object_id))
+
+
+def track_all_chunks_dependency():
+    for dependencies in getattr(_local, 'dependencies', None) or ():
+        dependencies.all_chunks = True
+
+
+class ChunksStats(object):
+    """Counters of chunks cache hits and misses, storage lookups done for
+    the misses, database queries and time of builders of one request.
+    Lookups aren't database queries, e.g. snapshot storage doesn't query
+    at all. Paths are `render_chunk`, `ObjChunkNode` and
+    `ChunksModel.chunks`"""
+    def __init__(self):
+        self.hits = defaultdict(int)
+        self.misses = defaultdict(int)
+        self.lookups = defaultdict(int)
+        self.builders = defaultdict(float)
+        self.queries = 0
+        # builders of the request may run in pool threads
+        self._lock = threading.Lock()
+
+    def hit(self, path, count=1):
+        with self._lock:
+            self.hits[path] += count
+
+    def miss(self, path, count=1):
+        with self._lock:
+            self.misses[path] += count
+
+    def lookup(self, path, count=1):
+        with self._lock:
+            self.lookups[path] += count
+
+    def query(self, count=1):
+        with self._lock:
+            self.queries += count
+
+    def builder_time(self, ident, seconds):
+        with self._lock:
+            self.builders[ident] += seconds
+
+    def as_dict(self):
+        paths = set(self.hits) | set(self.misses) | set(self.lookups)
+        return {'paths': dict((path, {'hits': self.hits[path],
+                                      'misses': self.misses[path],
+                                      'lookups': self.lookups[path]})
+                              for path in paths),
+                'builders': dict(self.builders),
+                'queries': self.queries,
+               }
+
+    def server_timing(self):
+        """Return value of Server-Timing header"""
+        metrics = [u'chunks;dur=%.3f;desc="hits=%d misses=%d lookups=%d ' \
+                   u'queries=%d"' % (
+                        sum(self.builders.values()) * 1000,
+                        sum(self.hits.values()), sum(self.misses.values()),
+                        sum(self.lookups.values()), self.queries)]
+        for path, values in sorted(self.as_dict()['paths'].items()):
+            metrics.append(u'chunks-%s;desc="hits=%d misses=%d lookups=%d"' \
+                    % (path.replace('.', '-'), values['hits'], \
+                       values['misses'], values['lookups']))
+        for ident, seconds in sorted(self.builders.items()):
+            metrics.append(u'chunks-builder-%s;dur=%.3f' % \
+                                (ident, seconds * 1000))
+        return u', '.join(metrics)
+
+
+def _start_queries():
+    # debug cursor records queries of connections of current thread
+    marks = {}
+    for connection in connections.all():
+        marks[connection.alias] = (connection.use_debug_cursor, \
+                                   len(connection.queries))
+        connection.use_debug_cursor = True
+    _local.query_marks = marks
+
+
+def _stop_queries():
+    """Return number of queries since `_start_queries` and restore debug
+    cursors, queries recorded only for stats are forgotten"""
+    marks = getattr(_local, 'query_marks', None) or {}
+    _local.query_marks = None
+    count = 0
+    for connection in connections.all():
+        if connection.alias not in marks:
+            continue
+        debug, start = marks[connection.alias]
+        count += max(len(connection.queries) - start, 0)
+        connection.use_debug_cursor = debug
+        if not (debug or (debug is None and settings.DEBUG)):
+            del connection.queries[start:]
+    return count
+
+
+def start_stats():
+    """Start collecting of chunks stats for current request"""
+    _local.stats = ChunksStats()
+    _start_queries()
+
+
+def stop_stats():
+    """Stop collecting and return stats of current request or None"""
+    stats = getattr(_local, 'stats', None)
+    _local.stats = None
+    if stats is not None:
+        stats.query(_stop_queries())
+    return stats
+
+
+def resume_stats(stats):
+    """Collect stats of current thread into `stats` of another thread,
+    e.g. in builders pool, until `stop_stats`"""
+    _local.stats = stats
+    _start_queries()
+
+
+def current_stats():
+    """Return stats of current request or None if they aren't collected"""
+    return getattr(_local, 'stats', None)
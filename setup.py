@@ -6,7 +6,8 @@ setup(name='chunks',
       author='Clint Ecker',
       author_email='me@clintecker.com',
       url='http://code.google.com/p/django-chunks/',
-      packages=['chunks', 'chunks.templatetags'],
+      packages=['chunks', 'chunks.templatetags', 'chunks.management',
+                'chunks.management.commands'],
       classifiers=['Development Status :: 4 - Beta',
                    'Environment :: Web Environment',
                    'Intended Audience :: Developers',